@@ -1,32 +1,47 @@
-from .blendmodes import BlendModes
-from .selectivecolor import SelectiveColor
-from .contrast import Levels
+from .blendmodes import BlendModes, BlendLayer, LayerStack
+from .selectivecolor import SelectiveColor, SelectiveColorMulti
+from .contrast import Levels, LevelsAdvanced
 from .blendif import BlendIf
 from .colors import SplitRGB, MergeRGB
 from .colors import ColorBalance, ColorBalanceAdvanced
 from .colors import BlackAndWhite
 from .colors import HueSatAdvanced, HueSat
 from .colors import SolidColorRGB, SolidColorHSV, SolidColor
+from .lut import LUTLattice, BakeLUT, ApplyLUT
+from .cube import LoadCubeLUT, SaveCubeLUT
 from .blur import MotionBlur, LensBlur, GaussianBlur, MotionBlurDepth, LensBlurDepth, GaussianBlurDepth
+from .blur import GaussianBlurStack, LensBlurStack, FocusBlurStack
 
 NODE_CLASS_MAPPINGS = {
     "BlackAndWhite": BlackAndWhite,
     "BlendIf": BlendIf,
     "BlendModes": BlendModes,
+    "BlendLayer": BlendLayer,
+    "LayerStack": LayerStack,
     "ColorBalance": ColorBalance,
     "ColorBalanceAdvanced": ColorBalanceAdvanced,
     "HueSat": HueSat,
     "HueSatAdvanced": HueSatAdvanced,
     "Levels": Levels,
+    "LevelsAdvanced": LevelsAdvanced,
+    "LUTLattice": LUTLattice,
+    "BakeLUT": BakeLUT,
+    "ApplyLUT": ApplyLUT,
+    "LoadCubeLUT": LoadCubeLUT,
+    "SaveCubeLUT": SaveCubeLUT,
     "LensBlur": LensBlur,
     "MotionBlur": MotionBlur,
     "GaussianBlur": GaussianBlur,
     "LensBlurDepth": LensBlurDepth,
     "MotionBlurDepth": MotionBlurDepth,
     "GaussianBlurDepth": GaussianBlurDepth,
+    "GaussianBlurStack": GaussianBlurStack,
+    "LensBlurStack": LensBlurStack,
+    "FocusBlurStack": FocusBlurStack,
     "MergeRGB": MergeRGB,
     "SplitRGB": SplitRGB,
     "SelectiveColor": SelectiveColor,
+    "SelectiveColorMulti": SelectiveColorMulti,
     "SolidColor": SolidColor,
     "SolidColorRGB": SolidColorRGB,
     "SolidColorHSV": SolidColorHSV
@@ -36,20 +51,32 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "BlackAndWhite": "Black and White",
     "BlendIf": "Blend If",
     "BlendModes": "Blend Modes",
+    "BlendLayer": "Blend Layer",
+    "LayerStack": "Layer Stack",
     "ColorBalance": "Color Balance",
     "ColorBalanceAdvanced": "Color Balance Advanced",
     "HueSat": "Hue/Saturation",
     "HueSatAdvanced": "Hue/Saturation Advanced",
     "Levels": "Levels",
+    "LevelsAdvanced": "Levels Advanced",
+    "LUTLattice": "LUT Lattice",
+    "BakeLUT": "Bake LUT",
+    "ApplyLUT": "Apply LUT",
+    "LoadCubeLUT": "Load Cube LUT",
+    "SaveCubeLUT": "Save Cube LUT",
     "LensBlur": "Lens Blur",
     "MotionBlur":"Motion Blur",
     "GaussianBlur": "Gaussian Blur",
     "LensBlurDepth": "Lens Blur with Depth Map",
     "MotionBlurDepth":"Motion Blur with Depth Map",
     "GaussianBlurDepth": "Gaussian Blur with Depth Map",
+    "GaussianBlurStack": "Gaussian Blur Stack",
+    "LensBlurStack": "Lens Blur Stack",
+    "FocusBlurStack": "Focus Blur Stack",
     "MergeRGB": "Merge RGB",
     "SplitRGB": "Split RGB",
     "SelectiveColor": "Selective Color",
+    "SelectiveColorMulti": "Selective Color Multi",
     "SolidColor": "Solid Color",
     "SolidColorRGB": "Solid Color RGB",
     "SolidColorHSV": "Solid Color HSV"
@@ -0,0 +1,107 @@
+"""
+Compares the RGB <-> HSV conversions in hsv.py with the chained torch.where versions they replaced.
+
+Run from anywhere, with torch installed:
+
+    python benchmarks/bench_hsv.py --batch 4 --device cpu
+
+The default frame size is 4K UHD (3840 x 2160). Reported times are the median of --repeat runs, and
+the largest difference between the two implementations is printed as a check.
+"""
+import argparse
+import importlib
+import importlib.util
+import pathlib
+import statistics
+import sys
+import time
+import torch
+
+def load_hsv():
+    # The nodes use relative imports, so hsv.py is loaded as part of the package without running
+    # the package __init__ (which pulls in every node and its dependencies)
+    root = pathlib.Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("virtuoso_bench", root / "__init__.py", submodule_search_locations=[str(root)])
+    sys.modules["virtuoso_bench"] = importlib.util.module_from_spec(spec)
+    return importlib.import_module("virtuoso_bench.hsv")
+
+## The previous implementation, kept here as the baseline
+def where_rgb_to_hsv(rgb):
+    r, g, b = rgb[:, :, :, 0:1], rgb[:, :, :, 1:2], rgb[:, :, :, 2:3]
+
+    max_val, _ = torch.max(rgb[:, :, :, :3], dim=-1, keepdim=True)
+    min_val, _ = torch.min(rgb[:, :, :, :3], dim=-1, keepdim=True)
+    diff = max_val - min_val
+
+    v = max_val
+
+    s = diff / v
+    s = torch.where(torch.isnan(s), torch.zeros_like(s), s)
+
+    h = torch.zeros_like(r)
+    h = torch.where((max_val == r) & (g >= b), ((g - b) / diff) / 6, h)
+    h = torch.where((max_val == r) & (g < b), ((g - b) / diff) / 6 + 1, h)
+    h = torch.where(max_val == g, ((b - r) / diff) / 6 + 1 / 3, h)
+    h = torch.where(max_val == b, ((r - g) / diff) / 6 + 2 / 3, h)
+    h = torch.where(max_val == min_val, torch.zeros_like(h), h)
+
+    if rgb.shape[-1] == 4:
+        return torch.cat((h, s, v, rgb[:, :, :, 3:4]), dim=-1)
+    return torch.cat((h, s, v), dim=-1)
+
+def where_hsv_to_rgb(hsv):
+    h, s, v = hsv[:, :, :, 0:1], hsv[:, :, :, 1:2], hsv[:, :, :, 2:3]
+
+    i = (h * 6).floor()
+    f = h * 6 - i
+    p = v * (1 - s)
+    q = v * (1 - f * s)
+    t = v * (1 - (1 - f) * s)
+
+    i = i % 6
+
+    r = torch.where(i == 0, v, torch.where(i == 1, q, torch.where(i == 2, p, torch.where(i == 3, p, torch.where(i == 4, t, v)))))
+    g = torch.where(i == 0, t, torch.where(i == 1, v, torch.where(i == 2, v, torch.where(i == 3, q, torch.where(i == 4, p, p)))))
+    b = torch.where(i == 0, p, torch.where(i == 1, p, torch.where(i == 2, t, torch.where(i == 3, v, torch.where(i == 4, v, q)))))
+
+    if hsv.shape[-1] == 4:
+        return torch.cat((r, g, b, hsv[:, :, :, 3:4]), dim=-1)
+    return torch.cat((r, g, b), dim=-1)
+
+def time_it(fn, x, repeat, device):
+    times = []
+    for _ in range(repeat):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    hsv = load_hsv()
+    device = torch.device(args.device)
+    rgb = torch.rand(args.batch, args.height, args.width, 3, device=device)
+    hsv_image = hsv.convert_rgb_to_hsv(rgb)
+
+    print(f"{args.batch} x {args.width}x{args.height} RGB on {device}, median of {args.repeat} runs")
+    for name, new, old, x in (("rgb_to_hsv", hsv.convert_rgb_to_hsv, where_rgb_to_hsv, rgb),
+                              ("hsv_to_rgb", hsv.hsv_to_rgb, where_hsv_to_rgb, hsv_image)):
+        new(x), old(x) # warm up
+        new_time = time_it(new, x, args.repeat, device)
+        old_time = time_it(old, x, args.repeat, device)
+        difference = (new(x) - old(x)).abs().max().item()
+        print(f"{name}: {old_time * 1000:8.1f} ms -> {new_time * 1000:8.1f} ms ({old_time / new_time:.1f}x), max difference {difference:.1e}")
+
+if __name__ == "__main__":
+    main()
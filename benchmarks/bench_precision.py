@@ -0,0 +1,108 @@
+"""
+Measures how far the float16 and bfloat16 precisions of the nodes are from their float32 results.
+
+Run from anywhere, with torch installed:
+
+    python benchmarks/bench_precision.py --size 512 --seed 0
+
+Every node is run on two sets of random 8-bit images: uniformly random colors, and nearly gray
+colors, whose hue is poorly defined. For each group of nodes in the README's Reduced Precision
+table, the largest difference from float32 over all nodes, settings and inputs of the group is
+printed in 8-bit steps, with the smallest share of pixels within one step, as markdown table rows.
+"""
+import argparse
+import importlib.util
+import pathlib
+import sys
+import torch
+
+def load_package():
+    # The nodes use relative imports, so the package is loaded under its own name. Unlike
+    # bench_hsv.py, this needs the node modules themselves, so the package __init__ is run.
+    root = pathlib.Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("virtuoso_bench", root / "__init__.py", submodule_search_locations=[str(root)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["virtuoso_bench"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def random_image(size, generator):
+    # An 8-bit RGB image with uniformly random values
+    return torch.randint(0, 256, (1, size, size, 3), generator=generator).float() / 255
+
+def gray_image(size, generator):
+    # An 8-bit RGB image of random grays, each channel off by up to 4 steps
+    gray = torch.randint(0, 256, (1, size, size, 1), generator=generator)
+    offsets = torch.randint(-4, 5, (1, size, size, 3), generator=generator)
+    return (gray + offsets).clamp(0, 255).float() / 255
+
+def cases(package, backdrop, source, image):
+    # (row of the table, name, function of the precision returning the output) for every node
+    # and setting measured
+    nodes = package.NODE_CLASS_MAPPINGS
+    lut = nodes["BakeLUT"]().do_bake(nodes["LUTLattice"]().do_lattice(17)[0] ** 0.8)[0]
+    hsv_modes = ("hue", "saturation", "color", "luminosity")
+    levels = {f"{prefix}_{name}": value for prefix in ("rgb", "red", "green", "blue")
+              for name, value in (("input_black_point", 0.05), ("input_gamma", 1.3), ("input_white_point", 0.95),
+                                  ("output_black_point", 0.02), ("output_white_point", 0.98))}
+    selective = {f"{color_range}_{name}": value for color_range in package.NODE_CLASS_MAPPINGS["SelectiveColor"].INPUT_TYPES()["required"]["color_range"][0]
+                 for name, value in (("cyan", 0.3), ("magenta", -0.2), ("yellow", 0.1), ("black", 0.15))}
+
+    for mode in package.NODE_CLASS_MAPPINGS["BlendModes"].INPUT_TYPES()["required"]["blend_mode"][0]:
+        row = "hsv" if mode in hsv_modes else "threshold" if mode in ("dissolve", "hard mix") else "pointwise"
+        yield row, f"blend {mode}", lambda p, mode=mode: nodes["BlendModes"]().do_blend(backdrop, source, mode, 0.8, "stretch", False, precision=p)[0]
+    yield "pointwise", "Levels", lambda p: nodes["Levels"]().do_levels(image, "RGB", 0.05, 1.3, 0.95, 0.02, 0.98, precision=p)[0]
+    yield "pointwise", "Levels Advanced", lambda p: nodes["LevelsAdvanced"]().do_levels(image, precision=p, **levels)[0]
+    yield "pointwise", "Black and White", lambda p: nodes["BlackAndWhite"]().do_black_and_white(image, 0.4, 0.6, 0.2, 0.6, 0.8, 0.6, precision=p)[0]
+    yield "pointwise", "Apply LUT", lambda p: nodes["ApplyLUT"]().do_apply(image, lut, "tetrahedral", precision=p)[0]
+    for method in ("relative", "absolute"):
+        yield "selective", f"Selective Color {method}", lambda p, method=method: nodes["SelectiveColor"]().do_selectivecolor(image, "reds", 0.3, -0.2, 0.1, 0.15, method, precision=p)[0]
+        yield "selective", f"Selective Color Multi {method}", lambda p, method=method: nodes["SelectiveColorMulti"]().do_selectivecolor(image, method, precision=p, **selective)[0]
+    for channel in ("gray", "red"):
+        yield "blendif", f"Blend If {channel}", lambda p, channel=channel: nodes["BlendIf"]().do_blendif(
+            source, backdrop, image, channel, 0.1, 0.3, 0.7, 0.9, 1.0, "stretch", False, precision=p)[0]
+    yield "huesat", "Hue/Saturation", lambda p: nodes["HueSat"]().do_hue_sat(image, "red", "normal", "normal", 30, 0.2, 0.1, precision=p)[0]
+    yield "huesat", "Hue/Saturation Advanced", lambda p: nodes["HueSatAdvanced"]().do_hue_sat(image, 300, 20, 60, 20, -40, 0.3, -0.1, precision=p)[0]
+
+rows = {
+    "pointwise": "Levels nodes, Black and White, Apply LUT, and all blend modes except those below",
+    "selective": "Selective Color nodes",
+    "hsv": "Hue, saturation, color and luminosity blend modes",
+    "threshold": "Dissolve and hard mix blend modes",
+    "blendif": "Blend If",
+    "huesat": "Hue/Saturation nodes",
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Print every node and setting, not only the rows")
+    args = parser.parse_args()
+
+    package = load_package()
+    generator = torch.Generator().manual_seed(args.seed)
+    inputs = {"random": [random_image(args.size, generator) for _ in range(3)],
+              "gray": [gray_image(args.size, generator) for _ in range(3)]}
+    results = {row: {"float16": [0.0, 1.0], "bfloat16": [0.0, 1.0]} for row in rows}
+    for kind, images in inputs.items():
+        for row, name, run in cases(package, *images):
+            reference = run("float32").float()
+            for precision in ("float16", "bfloat16"):
+                # 0 / 0 in the divide, color dodge and color burn modes is NaN at every precision
+                steps = (run(precision).float() - reference).abs().nan_to_num(0) * 255
+                largest, within = steps.max().item(), (steps <= 1).float().mean().item()
+                worst = results[row][precision]
+                worst[0], worst[1] = max(worst[0], largest), min(worst[1], within)
+                if args.verbose:
+                    print(f"{name}, {kind} {precision}: up to {largest:.2f} steps, {within:.2%} within 1")
+
+    print(f"{args.size}x{args.size} images, seed {args.seed}: largest difference in 8-bit steps (share of pixels within 1 step)")
+    print("| Nodes | float16 | bfloat16 |")
+    print("| --- | --- | --- |")
+    for row, label in rows.items():
+        cells = [f"{largest:.1f} ({within:.2%})" for largest, within in (results[row][p] for p in ("float16", "bfloat16"))]
+        print(f"| {label} | {cells[0]} | {cells[1]} |")
+
+if __name__ == "__main__":
+    main()
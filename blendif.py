@@ -6,6 +6,8 @@
 """
 import torch
 from .resize import match_sizes
+from .precision import precision_names, to_precision, restore_precision, upcast
+from .tiling import tiled
 
 class BlendIf:
     
@@ -61,6 +63,13 @@ class BlendIf:
             },
             "optional": {
                 "mask": ("MASK",),
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
             }
         }
 
@@ -68,11 +77,8 @@ class BlendIf:
     FUNCTION = "do_blendif"
     CATEGORY = "Virtuoso"
 
-    def do_blendif(self, top_layer, bottom_layer, blend_if_layer, blend_if_channel, start_rise, end_rise, start_fall, end_fall, opacity, match_size, invert_mask, mask=None):
+    def do_blendif(self, top_layer, bottom_layer, blend_if_layer, blend_if_channel, start_rise, end_rise, start_fall, end_fall, opacity, match_size, invert_mask, mask=None, tile_size=0, precision="float32"):
         
-        t = top_layer.clone()
-        b = bottom_layer.clone()
-          
         # Ensure the parameters are in order
         parameters = [end_fall, start_fall, end_rise, start_rise]
         for i in range(len(parameters) - 1):
@@ -81,44 +87,54 @@ class BlendIf:
                     parameters[i] = parameters[j]
         end_fall_adjusted, start_fall_adjusted, end_rise_adjusted, start_rise_adjusted = parameters
 
-        # Remove alpha channel if it exists (we use mask parameter if passed in)
-        if t.shape[-1] == 4:
-            t = t[..., :3]
-        if b.shape[-1] == 4:
-            b = b[..., :3]
+        # Remove alpha channel if it exists (we use mask parameter if passed in). Layers stay views, and
+        # batches of size 1 or N are broadcast against each other rather than copied.
+        dtype = bottom_layer.dtype
+        t = to_precision(precision, top_layer[..., :3])
+        b = to_precision(precision, bottom_layer[..., :3])
+        mask = to_precision(precision, mask)
 
-        t, m = match_sizes(match_size, top_layer, bottom_layer, mask)
+        t, m = match_sizes(match_size, t, b, mask)
 
         # Invert the mask if required
         if invert_mask == 'yes' and m is not None:
             m = 1 - m
 
-        # Calculate the base opacity
-        if blend_if_channel == 'gray':
-            if blend_if_layer == 'bottom':
-                luminosity = 0.2126 * b[..., 0] + 0.7152 * b[..., 1] + 0.0722 * b[..., 2]
-            else:  # blend_if_layer == 'top'
-                luminosity = 0.2126 * t[..., 0] + 0.7152 * t[..., 1] + 0.0722 * t[..., 2]
-            base_opacity = calculate_opacity(luminosity, start_rise_adjusted, end_rise_adjusted, start_fall_adjusted, end_fall_adjusted)
-        else:
-            channel_index = {'red': 0, 'green': 1, 'blue': 2}[blend_if_channel]
-            if blend_if_layer == 'bottom':
-                base_opacity = calculate_opacity(b[..., channel_index], start_rise_adjusted, end_rise_adjusted, start_fall_adjusted, end_fall_adjusted)
-            else:  # blend_if_layer == 'top'
-                base_opacity = calculate_opacity(t[..., channel_index], start_rise_adjusted, end_rise_adjusted, start_fall_adjusted, end_fall_adjusted)
+        result = tiled(blend_if, tile_size, t, b, m, blend_if_layer, blend_if_channel,
+                       start_rise_adjusted, end_rise_adjusted, start_fall_adjusted, end_fall_adjusted, opacity)
+        return restore_precision(result, dtype)
+
+
+def blend_if(t, b, m, blend_if_layer, blend_if_channel, start_rise, end_rise, start_fall, end_fall, opacity):
+
+    # Calculate the base opacity
+    if blend_if_channel == 'gray':
+        if blend_if_layer == 'bottom':
+            luminosity = 0.2126 * b[..., 0] + 0.7152 * b[..., 1] + 0.0722 * b[..., 2]
+        else:  # blend_if_layer == 'top'
+            luminosity = 0.2126 * t[..., 0] + 0.7152 * t[..., 1] + 0.0722 * t[..., 2]
+        base_opacity = calculate_opacity(luminosity, start_rise, end_rise, start_fall, end_fall)
+    else:
+        channel_index = {'red': 0, 'green': 1, 'blue': 2}[blend_if_channel]
+        if blend_if_layer == 'bottom':
+            base_opacity = calculate_opacity(b[..., channel_index], start_rise, end_rise, start_fall, end_fall)
+        else:  # blend_if_layer == 'top'
+            base_opacity = calculate_opacity(t[..., channel_index], start_rise, end_rise, start_fall, end_fall)
 
-        # Apply the mask and the opacity parameter
-        if m is not None:
-            final_opacity = base_opacity * m * opacity
-        else:
-            final_opacity = base_opacity * opacity
+    # Apply the mask and the opacity parameter
+    if m is not None:
+        final_opacity = base_opacity * m * opacity
+    else:
+        final_opacity = base_opacity * opacity
 
-        # Composite the top_layer onto the bottom_layer
-        new_image = final_opacity[..., None] * t + (1.0 - final_opacity[..., None]) * b
+    # Composite the top_layer onto the bottom_layer
+    new_image = torch.lerp(b, t, final_opacity[..., None])
 
-        return (new_image, base_opacity)
+    return (new_image, base_opacity)
 
 
+# The rise and fall ramps divide by the width of their range, so they are computed in float32
+@upcast
 def calculate_opacity(t, start_rise, end_rise, start_fall, end_fall):
     # Values to the left of start_rise and to the right of end_fall return 0
     opacity = torch.zeros_like(t)
@@ -2,16 +2,24 @@
 @author: Chris Freilich
 @title: Virtuoso Pack - Blend Modes
 @nickname: Virtuoso Pack - Blend Nodes
-@description: This extension provides a blend modes node with 30 blend modes.
+@description: This extension provides a blend modes node with 30 blend modes, and Blend Layer and
+Layer Stack nodes that composite many layers in one pass.
 """
-import numpy as np
+from functools import partial
 import torch
 import torch.nn.functional as F
-from blend_modes import grain_extract, grain_merge
+from .cache import LRUCache, tensor_key
 from .resize import match_sizes
 from .hsv import rgb_to_hsv, hsv_to_rgb
+from .precision import precision_names, to_precision, restore_precision, is_reduced
+from .tiling import tiled
 
-modes_8bit = ["grain extract", "grain merge"]
+blend_mode_names = ["normal", "dissolve", "darken", "multiply", "color burn", "linear burn", "darker color", 
+                    "lighten", "screen", "color dodge", "linear dodge (add)", "lighter color",
+                    "overlay", "soft light", "hard light", "vivid light", "linear light", "pin light", "hard mix",
+                    "difference", "exclusion", "subtract",  "divide",
+                    "hue", "saturation", "color", "luminosity", 
+                    "grain extract", "grain merge"]
 
 class BlendModes:
     
@@ -25,12 +33,7 @@ class BlendModes:
             "required": {
                 "backdrop": ("IMAGE",),
                 "source": ("IMAGE",),
-                "blend_mode": (["normal", "dissolve", "darken", "multiply", "color burn", "linear burn", "darker color", 
-                                "lighten", "screen", "color dodge", "linear dodge (add)", "lighter color",
-                                "overlay", "soft light", "hard light", "vivid light", "linear light", "pin light", "hard mix",
-                                "difference", "exclusion", "subtract",  "divide",
-                                "hue", "saturation", "color", "luminosity", 
-                                "grain extract", "grain merge"],),
+                "blend_mode": (blend_mode_names,),
                 "opacity": ("FLOAT", {
                     "default": 1.0,
                     "min": 0.0,
@@ -43,6 +46,17 @@ class BlendModes:
             },
             "optional": {
                 "mask": ("MASK",),
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
+                "seed": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 0xffffffffffffffff}),
             }
         }
 
@@ -50,242 +64,488 @@ class BlendModes:
     FUNCTION = "do_blend"
     CATEGORY = "Virtuoso"
     
-    def do_blend(self, backdrop, source, blend_mode, opacity, source_adjust, invert_mask, mask=None ):
-
-            backdrop_prepped = handle_alpha(backdrop, False)
-            source_prepped = handle_alpha(source, invert_mask, mask)
-            source_prepped, _ = match_sizes(source_adjust, source_prepped, backdrop_prepped)
-            if blend_mode in modes_8bit:
-                source_prepped = source_prepped.squeeze(0)
-                backdrop_prepped = backdrop_prepped.squeeze(0)
-                source_prepped = source_prepped * 255
-                backdrop_prepped = backdrop_prepped * 255
-                final_tensor = torch.from_numpy(modes[blend_mode](backdrop_prepped.numpy(), source_prepped.numpy(), opacity)).unsqueeze(0)
+    def do_blend(self, backdrop, source, blend_mode, opacity, source_adjust, invert_mask, mask=None, tile_size=0, precision="float32", seed=0):
+
+            # The cache is keyed by the node's inputs, before any cast to the compute precision
+            cache_key = (blend_mode, source_adjust, precision, tensor_key(backdrop), tensor_key(source))
+            owners = (backdrop, source)
+            dtype = backdrop.dtype
+            backdrop, source, mask = (to_precision(precision, t) for t in (backdrop, source, mask))
+
+            # Layers, masks and their batches (1 or N) are passed through as views and broadcast by the blend
+            source_alpha = handle_alpha(source, invert_mask, mask)
+            source_prepped, _ = match_sizes(source_adjust, source, backdrop)
+            if source_alpha is not None:
+                source_alpha, _ = match_sizes(source_adjust, source_alpha, backdrop)
+            if blend_mode == "dissolve":
+                noise = dissolve_noise(seed, backdrop)
+                final_tensor = tiled(dissolve, tile_size, backdrop, source_prepped, opacity, source_alpha, noise)
+            elif not tile_size and blend_mode in raw_modes:
+                final_tensor = cached_blend(blend_mode, cache_key, owners, backdrop, source_prepped, opacity, source_alpha)
             else:
-                final_tensor = modes[blend_mode](backdrop_prepped, source_prepped, opacity)
+                final_tensor = tiled(modes[blend_mode], tile_size, backdrop, source_prepped, opacity, source_alpha)
             
-            return (final_tensor,)
+            return (restore_precision(final_tensor, dtype),)
         
-def handle_alpha(img, invert_mask="true", mask=None):
-
-    alpha_img = img.clone()
-
-    if mask is None:        
-        if alpha_img.shape[3] == 4: # If img already has an alpha channel, use it
-            alpha_channel = alpha_img[:, :, 3:4]
-        else:
-            alpha_channel = torch.full((1, alpha_img.shape[1], alpha_img.shape[2], 1), fill_value=1, dtype=img.dtype, device=img.device)
-    else:
-        alpha_channel = mask.clone()
-        if invert_mask == "yes":
-            alpha_channel = 1 - alpha_channel
-        _, h, w, _ = alpha_img.shape
-        alpha_channel = F.interpolate(alpha_channel[None, ...], size=(h, w), mode='bilinear', align_corners=False)[0]
-
-    if len(alpha_channel.shape) < len(alpha_img.shape):
-        alpha_channel = alpha_channel.unsqueeze(-1)
-
-    if alpha_img.shape[3] == 4:    # If img already has an alpha channel, replace it
-        alpha_img[:, :, 3:4] = alpha_channel
-    else:
-        batch_size = alpha_img.shape[0]
-        alpha_channel_repeated = alpha_channel.repeat(batch_size, 1, 1, 1)
-        alpha_img = torch.cat((alpha_img, alpha_channel_repeated), dim=3)
-
-    return alpha_img
-
-def dissolve(backdrop, source, opacity):
+class BlendLayer:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "source": ("IMAGE",),
+                "blend_mode": (blend_mode_names,),
+                "opacity": ("FLOAT", {
+                    "default": 1.0,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "round": 0.001, 
+                    "display": "number"}),
+                "source_adjust": (["crop", "stretch"],),
+                "invert_mask": (["yes", "no"],),
+            },
+            "optional": {
+                "mask": ("MASK",),
+                "layer_stack": ("LAYER_STACK",),
+                "seed": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 0xffffffffffffffff}),
+            }
+        }
 
-    transparency = opacity * source[..., 3]
-    random_matrix = torch.rand_like(transparency)
-    mask = random_matrix < transparency
+    RETURN_TYPES = ("LAYER_STACK",)
+    FUNCTION = "add_layer"
+    CATEGORY = "Virtuoso"
 
-    # Use the mask to select pixels from the source or backdrop
-    blend = torch.where(mask[..., None], source[..., :3], backdrop[..., :3])
+    def add_layer(self, source, blend_mode, opacity, source_adjust, invert_mask, mask=None, layer_stack=None, seed=0):
+        # Layers are listed bottom to top. A new list is returned so upstream outputs are never modified.
+        layer = {"source": source, "blend_mode": blend_mode, "opacity": opacity,
+                 "source_adjust": source_adjust, "invert_mask": invert_mask, "mask": mask, "seed": seed}
+        return ((layer_stack or []) + [layer],)
 
-    # Apply the alpha channel of the source image to the blended image
-    new_rgb = (1 - source[..., 3, None]) * backdrop[..., :3] + source[..., 3, None] * blend
+class LayerStack:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "backdrop": ("IMAGE",),
+                "layer_stack": ("LAYER_STACK",),
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+            }
+        }
 
-    # Ensure the RGB values are within the valid range
-    new_rgb = torch.clamp(new_rgb, 0, 1)
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "do_stack"
+    CATEGORY = "Virtuoso"
 
-    # Calculate the new alpha value by taking the maximum of the backdrop and source alpha channels
-    new_alpha = torch.max(backdrop[..., 3], source[..., 3])
+    def do_stack(self, backdrop, layer_stack, tile_size=0):
+
+        # Each layer's alpha and size are prepared once, against the backdrop
+        planes = []
+        settings = []
+        for layer in layer_stack:
+            source_alpha = handle_alpha(layer["source"], layer["invert_mask"], layer["mask"])
+            source_prepped, _ = match_sizes(layer["source_adjust"], layer["source"], backdrop)
+            if source_alpha is not None:
+                source_alpha, _ = match_sizes(layer["source_adjust"], source_alpha, backdrop)
+            noise = dissolve_noise(layer["seed"], backdrop) if layer["blend_mode"] == "dissolve" else None
+            planes.extend((source_prepped, source_alpha, noise))
+            settings.append((layer["blend_mode"], layer["opacity"]))
+
+        # The whole stack is then composited one tile at a time, so intermediate states are never full frames
+        final_tensor = tiled(composite_layers, tile_size, backdrop, *planes, settings=settings)
+
+        return (final_tensor,)
+
+def composite_layers(backdrop, *planes, settings):
+    # planes holds (source, source_alpha, dissolve noise) for each layer, bottom to top
+    result = backdrop
+    for i, (blend_mode, opacity) in enumerate(settings):
+        source, source_alpha, noise = planes[3 * i:3 * i + 3]
+        if blend_mode == "dissolve":
+            result = dissolve(result, source, opacity, source_alpha, noise)
+        else:
+            result = modes[blend_mode](result, source, opacity, source_alpha)
+    return result
 
-    # Create a new RGBA image with the calculated RGB and alpha values
-    result = torch.cat((new_rgb, new_alpha[..., None]), dim=-1)
+def cached_blend(blend_mode, key, owners, backdrop, source_prepped, opacity, source_alpha):
+    # Opacity and the mask only enter in the final composite, so the raw blend of each backdrop/source
+    # pair is kept: when only opacity or the mask change, just the composite is redone.
+    blend, composite_blend = raw_modes[blend_mode]
+    raw = blend_cache.get(key, owners)
+    if raw is None:
+        raw = blend_cache.put(key, blend(backdrop, source_prepped), owners)
+    return composite_blend(backdrop, raw, layer_weight(source_prepped, opacity, source_alpha))
 
-    return result
+def handle_alpha(img, invert_mask="true", mask=None):
+    # Returns the alpha plane for img built from an external mask, as [batch, height, width, 1].
+    # Without a mask, None is returned: the blend modes use the layer's own alpha channel,
+    # or treat it as fully opaque, so no alpha channel has to be attached to the image.
+    if mask is None:
+        return None
+
+    alpha_channel = mask if mask.dim() == 3 else mask.unsqueeze(0)
+    if invert_mask == "yes":
+        alpha_channel = 1 - alpha_channel
+
+    _, h, w, _ = img.shape
+    if alpha_channel.shape[1:] != (h, w):
+        alpha_channel = F.interpolate(alpha_channel.unsqueeze(1), size=(h, w), mode='bilinear', align_corners=False).squeeze(1)
+
+    return alpha_channel.unsqueeze(-1).to(img.dtype)
+
+def get_alpha(img, alpha=None):
+    # The alpha plane of a layer: an explicit one, its own alpha channel, or None when it is opaque
+    if alpha is not None:
+        return alpha
+    return img[..., 3:4] if img.shape[-1] == 4 else None
+
+def layer_weight(source, opacity, source_alpha=None):
+    # How much of the blend replaces the backdrop at each pixel
+    alpha = get_alpha(source, source_alpha)
+    return opacity if alpha is None else alpha * opacity
+
+def copy_alpha(out, backdrop):
+    # The result keeps the backdrop's alpha channel (fully opaque if it has none)
+    if backdrop.shape[-1] == 4:
+        out[..., 3:4] = backdrop[..., 3:4]
+    else:
+        out[..., 3:4] = 1
+
+def new_output(backdrop, *layers, channels=4):
+    # One output per blend, sized to the broadcast of the backdrop, source and alpha batches
+    shapes = [layer.shape[:-1] for layer in (backdrop,) + layers if isinstance(layer, torch.Tensor)]
+    shape = torch.broadcast_shapes(*shapes) + (channels,)
+    return torch.empty(shape, dtype=backdrop.dtype, device=backdrop.device)
+
+def dissolve_noise(seed, backdrop):
+    # The noise field for a seed and frame size is made once and shared by every frame of a batch,
+    # so renders are reproducible and a video batch doesn't draw a new random frame per image.
+    # It is drawn on the CPU, which gives the same pattern for a seed on every device.
+    height, width = backdrop.shape[1], backdrop.shape[2]
+    key = (seed, height, width, backdrop.device, backdrop.dtype)
+    noise = noise_cache.get(key)
+    if noise is None:
+        generator = torch.Generator().manual_seed(seed)
+        noise = torch.rand((1, height, width, 1), generator=generator)
+        noise = noise_cache.put(key, noise.to(device=backdrop.device, dtype=backdrop.dtype))
+    return noise
+
+def dissolve(backdrop, source, opacity, source_alpha=None, noise=None):
+
+    if noise is None:
+        noise = dissolve_noise(0, backdrop)
+    source_alpha = get_alpha(source, source_alpha)
+    out = new_output(backdrop, source, source_alpha)
+    rgb = out[..., :3]
+
+    # Take source pixels wherever the noise falls under the source's transparency
+    torch.where(noise < layer_weight(source, opacity, source_alpha), source[..., :3], backdrop[..., :3], out=rgb)
+
+    # Apply the alpha channel of the source image to the blended image, and keep it in range
+    if source_alpha is not None:
+        torch.lerp(backdrop[..., :3], rgb, source_alpha, out=rgb)
+    rgb.clamp_(0, 1)
+
+    # The new alpha value is the maximum of the backdrop and source alpha channels
+    backdrop_alpha = get_alpha(backdrop)
+    if backdrop_alpha is None or source_alpha is None:
+        out[..., 3:4] = 1
+    else:
+        torch.maximum(backdrop_alpha, source_alpha, out=out[..., 3:4])
 
-def hsv(backdrop, source, opacity, channel):
+    return out
 
-    source_alpha = source[:, :, :, 3:4]
+def composite(backdrop, blend, weight, out=None):
+    # (1 - weight) * backdrop + weight * blend, with the backdrop's alpha. out may already hold the blend.
+    if out is None:
+        out = new_output(backdrop, blend, weight)
+    torch.lerp(backdrop[..., :3], blend, weight, out=out[..., :3])
+    copy_alpha(out, backdrop)
+    return out
 
+def hsv_pair(backdrop, source):
     # Convert RGB to HSV
-    backdrop_hsv = rgb_to_hsv(backdrop)
-    source_hsv = rgb_to_hsv(source)
+    return rgb_to_hsv(backdrop[..., :3]), rgb_to_hsv(source[..., :3])
+
+def composite_hsv(backdrop, hsv_layers, weight, channel):
 
-    new_hsv = backdrop_hsv.clone()
+    backdrop_hsv, source_hsv = hsv_layers
+    new_hsv = new_output(backdrop_hsv, source_hsv, weight, channels=3)
+    new_hsv.copy_(backdrop_hsv)
     if channel == "saturation":
-        new_hsv[:, :, :, 1:2] = (1 - opacity * source_alpha) * backdrop_hsv[:, :, :, 1:2] + opacity * source_alpha * source_hsv[:, :, :, 1:2]
+        new_hsv[..., 1:2].lerp_(source_hsv[..., 1:2], weight)
     elif channel == "luminance":
-        new_hsv[:, :, :, 2:3] = (1 - opacity * source_alpha) * backdrop_hsv[:, :, :, 2:3] + opacity * source_alpha * source_hsv[:, :, :, 2:3]
+        new_hsv[..., 2:3].lerp_(source_hsv[..., 2:3], weight)
     elif channel == "hue":
-        new_hue = source_hsv[:, :, :, 0:1]
-        mask = (source_hsv[:, :, :, 1:2] == 0) # if sat == 0, sat = 0 in new image
-        new_saturation = torch.where(mask, source_hsv[:, :, :, 1:2], backdrop_hsv[:, :, :, 1:2])
-        new_hsv[:, :, :, 0:1] = new_hue
-        new_hsv[:, :, :, 1:2] = new_saturation
+        new_hsv[..., 0:1] = source_hsv[..., 0:1]
+        new_hsv[..., 1:2].masked_fill_(source_hsv[..., 1:2] == 0, 0) # if sat == 0, sat = 0 in new image
     elif channel == "color":
-        new_hsv[:, :, :, :2] = (1 - opacity * source_alpha) * backdrop_hsv[:, :, :, :2] + opacity * source_alpha * source_hsv[:, :, :, :2]
-    
-    new_rgb = hsv_to_rgb(new_hsv) 
-    new_rgb = (1 - source_alpha * opacity) * backdrop + source_alpha * opacity * new_rgb  
-    new_rgb = torch.clamp(new_rgb, 0, 1)
-    rgb_channels = new_rgb[:, :, :, :3]
-    backdrop_alpha = backdrop[:, :, :, 3:4]
-    new_img = torch.cat((rgb_channels, backdrop_alpha), dim=-1)
-    return new_img
+        new_hsv[..., :2].lerp_(source_hsv[..., :2], weight)
 
-def saturation(backdrop, source, opacity):   
-    return hsv(backdrop, source, opacity, "saturation")
+    out = composite(backdrop, hsv_to_rgb(new_hsv), weight)
+    out[..., :3].clamp_(0, 1)
+    return out
 
-def luminance(backdrop, source, opacity):
-    return hsv(backdrop, source, opacity, "luminance")
+def hsv(backdrop, source, opacity, channel, source_alpha=None):
+    return composite_hsv(backdrop, hsv_pair(backdrop, source), layer_weight(source, opacity, source_alpha), channel)
 
-def hue(backdrop, source, opacity):
-    return hsv(backdrop, source, opacity, "hue")
+def saturation(backdrop, source, opacity, source_alpha=None):   
+    return hsv(backdrop, source, opacity, "saturation", source_alpha)
 
-def color(backdrop, source, opacity):
-    return hsv(backdrop, source, opacity, "color")
+def luminance(backdrop, source, opacity, source_alpha=None):
+    return hsv(backdrop, source, opacity, "luminance", source_alpha)
 
-def darker_lighter_color(backdrop, source, opacity, type):
+def hue(backdrop, source, opacity, source_alpha=None):
+    return hsv(backdrop, source, opacity, "hue", source_alpha)
 
-    # Convert RGB to HSV
-    backdrop_hsv = rgb_to_hsv(backdrop)
-    source_hsv = rgb_to_hsv(source)
+def color(backdrop, source, opacity, source_alpha=None):
+    return hsv(backdrop, source, opacity, "color", source_alpha)
+
+def darker_lighter_blend(backdrop, source, type, out=None):
+
+    if out is None:
+        out = new_output(backdrop, source, channels=3)
+    b, s = backdrop[..., :3].expand(out.shape), source[..., :3].expand(out.shape)
+
+    # The HSV value of a pixel is its largest RGB channel, so no full HSV conversion is needed
+    backdrop_value = b.amax(dim=-1, keepdim=True)
+    source_value = s.amax(dim=-1, keepdim=True)
 
     # Create a mask where the value (brightness) of the source image is less than the value of the backdrop image
     if type == "dark":
-        mask = source_hsv[:, :, :, 2] < backdrop_hsv[:, :, :, 2]
+        mask = source_value < backdrop_value
     else:
-        mask = source_hsv[:, :, :, 2] > backdrop_hsv[:, :, :, 2]
+        mask = source_value > backdrop_value
 
     # Use the mask to select pixels from the source or backdrop
-    blend = torch.where(mask.unsqueeze(-1), source, backdrop)
-
-    source_alpha = source[:, :, :, 3:4]
-    new_rgb = (1 - source_alpha * opacity) * backdrop + source_alpha * opacity * blend
-    rgb_channels = new_rgb[:, :, :, :3]
-    backdrop_alpha = backdrop[:, :, :, 3:4]
-    new_img = torch.cat((rgb_channels, backdrop_alpha), dim=-1)
-    return new_img
+    return torch.where(mask, s, b, out=out)
 
-def darker_color(backdrop, source, opacity):
-    return darker_lighter_color(backdrop, source, opacity, "dark")
+def darker_lighter_color(backdrop, source, opacity, type, source_alpha=None):
 
-def lighter_color(backdrop, source, opacity):
-    return darker_lighter_color(backdrop, source, opacity, "light")
-
-def simple_mode(backdrop, source, opacity, mode):
-    
-    if mode == "linear_burn":
-        blend = backdrop + source - 1  
-    elif mode == "darken_only":
-        rgb_min = torch.min(backdrop[..., :3], source[..., :3]) 
-        alpha = backdrop[..., 3:]
-        blend = torch.cat([rgb_min, alpha], dim=-1) 
-    elif mode == "lighten_only":
-        rgb_min = torch.max(backdrop[..., :3], source[..., :3]) 
-        alpha = backdrop[..., 3:]
-        blend = torch.cat([rgb_min, alpha], dim=-1) 
-    elif mode == "difference":
-        blend = abs(backdrop - source)
-    elif mode == "normal":
-        blend = source
-    elif mode == "addition":
-        blend = source + backdrop
-    elif mode == "multiply":
-        blend = source * backdrop
-    elif mode == "divide":
-        blend = backdrop / source
-    elif mode == "screen":
-        blend = 1 - (1-source)*(1-backdrop)
-    elif mode == "linear_light":
-        blend = backdrop + (2 * source) - 1
-    elif mode == "color_dodge":
-        blend = backdrop / (1 - source)  
-    elif mode == "color_burn":
-        blend = 1 - ((1 - backdrop) / source)   
-    elif mode == "exclusion":
-        blend = backdrop + source - (2 * backdrop * source)
-    elif mode == "subtract":
-        blend = backdrop - source
-    elif mode == "soft_light":
-        blend = torch.where(source <= 0.5, 2 * backdrop * source + backdrop * backdrop * (1 - 2 * source), 2 * backdrop * (1 - source) + torch.sqrt(backdrop) * ((2 * source) - 1))        
-    elif mode == "overlay":
-        blend = torch.where(backdrop <= 0.5, 2 * backdrop * source, 1 - 2 * (1 - backdrop) * (1 - source))
-    elif mode == "hard_light":
-        blend = torch.where(source <= 0.5, 2 * source * backdrop, 1 - 2 * (1 - backdrop) * (1 - source))
-    elif mode == "vivid_light":
-        blend = torch.where(source <= 0.5, backdrop / (1 - 2 * source), 1 - (1 -backdrop) / (2 * source - 0.5) ) 
-    elif mode == "pin_light":
-        blend = torch.where(source <= 0.5, torch.minimum(backdrop, 2 * source), torch.maximum(backdrop, 2 * (source - 0.5)))  
-    elif mode == "hard_mix":
-        blend = simple_mode(backdrop, source, opacity, "linear_light")
-        rgb_channels = torch.round(blend[:, :, :, :3])
-        alpha_channel = blend[:, :, :, 3:4]
-        blend = torch.cat((rgb_channels, alpha_channel), dim=-1)
-
-    blend = torch.clamp(blend, 0, 1) 
-
-    source_alpha = source[:, :, :, 3:4]
-    new_rgb = (1 - source_alpha * opacity) * backdrop + source_alpha * opacity * blend
-    rgb_channels = new_rgb[:, :, :, :3]
-    backdrop_alpha = backdrop[:, :, :, 3:4]
-    new_img = torch.cat((rgb_channels, backdrop_alpha), dim=-1)
-    return new_img
-
-def normal(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "normal")
-def difference(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "difference")
-def multiply(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "multiply")
-def divide(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "divide")
-def addition(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "addition")
-def linear_light(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "linear_light")
-def vivid_light(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "vivid_light")
-def pin_light(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "pin_light")
-def hard_mix(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "hard_mix")
-def linear_burn(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "linear_burn")
-def color_dodge(backdrop, source, opacity): 
-    return simple_mode(backdrop, source, opacity, "color_dodge") 
-def color_burn(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "color_burn")
-def exclusion(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "exclusion")
-def subtract(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "subtract")
-def screen(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "screen")
-def soft_light(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "soft_light")
-def hard_light(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "hard_light")
-def overlay(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "overlay")
-def darken_only(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "darken_only")
-def lighten_only(backdrop, source, opacity):
-    return simple_mode(backdrop, source, opacity, "lighten_only")
+    weight = layer_weight(source, opacity, source_alpha)
+    out = new_output(backdrop, source, weight)
+    darker_lighter_blend(backdrop, source, type, out[..., :3])
+    return composite(backdrop, out[..., :3], weight, out)
+
+def darker_color(backdrop, source, opacity, source_alpha=None):
+    return darker_lighter_color(backdrop, source, opacity, "dark", source_alpha)
+
+def lighter_color(backdrop, source, opacity, source_alpha=None):
+    return darker_lighter_color(backdrop, source, opacity, "light", source_alpha)
+
+def simple_blend(backdrop, source, mode, out=None):
+    # Runs a blend kernel and clamps the result, in place in out
+    if out is None:
+        out = new_output(backdrop, source, channels=3)
+    blend_kernels[mode](backdrop[..., :3].expand(out.shape), source[..., :3].expand(out.shape), out)
+    return out.clamp_(0, 1)
+
+def simple_mode(backdrop, source, opacity, mode, source_alpha=None):
+
+    # The blend is written straight into the RGB planes of the output, then clamped and
+    # composited over the backdrop in place, so each blend allocates a single full frame.
+    weight = layer_weight(source, opacity, source_alpha)
+    out = new_output(backdrop, source, weight)
+    simple_blend(backdrop, source, mode, out[..., :3])
+    return composite(backdrop, out[..., :3], weight, out)
+
+## Blend kernels
+# Each kernel writes the blend of the backdrop (b) and source (s) RGB planes into out.
+# b and s are expanded (as views) to the shape of out. Branching modes need one scratch frame.
+def _normal(b, s, out):
+    out.copy_(s)
+
+def _multiply(b, s, out):
+    torch.mul(b, s, out=out)
+
+def _screen(b, s, out):
+    # 1 - (1 - s) * (1 - b) == b + s - b * s
+    torch.mul(b, s, out=out).neg_().add_(b).add_(s)
+
+def _addition(b, s, out):
+    torch.add(b, s, out=out)
+
+def _subtract(b, s, out):
+    torch.sub(b, s, out=out)
+
+def _difference(b, s, out):
+    torch.sub(b, s, out=out).abs_()
+
+def _divide(b, s, out):
+    torch.div(b, s, out=out)
+
+def _exclusion(b, s, out):
+    torch.mul(b, s, out=out).mul_(-2).add_(b).add_(s)
+
+def _linear_burn(b, s, out):
+    torch.add(b, s, out=out).sub_(1)
+
+def _linear_light(b, s, out):
+    torch.add(b, s, alpha=2, out=out).sub_(1)
+
+def _color_dodge(b, s, out):
+    # b / (1 - s)
+    out.copy_(s).neg_().add_(1)
+    torch.div(b, out, out=out)
+
+def _color_burn(b, s, out):
+    # 1 - (1 - b) / s
+    out.copy_(b).neg_().add_(1).div_(s).neg_().add_(1)
+
+def _darken_only(b, s, out):
+    torch.minimum(b, s, out=out)
+
+def _lighten_only(b, s, out):
+    torch.maximum(b, s, out=out)
+
+def _multiply_or_screen(b, s, out, use_multiply):
+    # Shared by overlay and hard light: 2 * b * s where use_multiply, else 1 - 2 * (1 - b) * (1 - s)
+    high = torch.empty_like(out)
+    _screen(b, s, high)
+    high.mul_(2).sub_(1)
+    torch.mul(b, s, out=out).mul_(2)
+    torch.where(use_multiply, out, high, out=out)
+
+def _overlay(b, s, out):
+    _multiply_or_screen(b, s, out, b <= 0.5)
+
+def _hard_light(b, s, out):
+    _multiply_or_screen(b, s, out, s <= 0.5)
+
+def _soft_light(b, s, out):
+    # s > 0.5: 2 * b * (1 - s) + sqrt(b) * (2 * s - 1)
+    high = torch.empty_like(out)
+    high.copy_(s).mul_(2).sub_(1).mul_(torch.sqrt(b)).addcmul_(b, 1 - s, value=2)
+    # s <= 0.5: 2 * b * s + b * b * (1 - 2 * s)
+    out.copy_(s).mul_(-2).add_(1).mul_(b).add_(s, alpha=2).mul_(b)
+    torch.where(s <= 0.5, out, high, out=out)
+
+def _vivid_light(b, s, out):
+    # s > 0.5: 1 - (1 - b) / (2 * s - 0.5)
+    high = torch.empty_like(out)
+    high.copy_(s).mul_(2).sub_(0.5)
+    torch.div(1 - b, high, out=high).neg_().add_(1)
+    # s <= 0.5: b / (1 - 2 * s)
+    out.copy_(s).mul_(-2).add_(1)
+    torch.div(b, out, out=out)
+    torch.where(s <= 0.5, out, high, out=out)
+
+def _pin_light(b, s, out):
+    doubled = torch.empty_like(out)
+    doubled.copy_(s).mul_(2)
+    torch.minimum(b, doubled, out=out)
+    torch.maximum(b, doubled.sub_(1), out=doubled)
+    torch.where(s <= 0.5, out, doubled, out=out)
+
+def _in_float32(kernel):
+    # Kernels dividing by (1 - s), s or similar amplify the rounding of float16/bfloat16 inputs
+    # near the pole, so with reduced-precision inputs they compute in float32
+    def run(b, s, out):
+        if not is_reduced(out):
+            return kernel(b, s, out)
+        wide = torch.empty(out.shape, dtype=torch.float32, device=out.device)
+        kernel(b.float(), s.float(), wide)
+        out.copy_(wide.clamp_(0, 1))
+    return run
+
+def _grain_extract(b, s, out):
+    torch.sub(b, s, out=out).add_(0.5)
+
+def _grain_merge(b, s, out):
+    torch.add(b, s, out=out).sub_(0.5)
+
+def _hard_mix(b, s, out):
+    _linear_light(b, s, out)
+    out.clamp_(0, 1).round_()
+
+blend_kernels = {
+    "normal": _normal,
+    "multiply": _multiply,
+    "screen": _screen,
+    "addition": _addition,
+    "subtract": _subtract,
+    "difference": _difference,
+    "divide": _in_float32(_divide),
+    "exclusion": _exclusion,
+    "linear_burn": _linear_burn,
+    "linear_light": _linear_light,
+    "color_dodge": _in_float32(_color_dodge),
+    "color_burn": _in_float32(_color_burn),
+    "darken_only": _darken_only,
+    "lighten_only": _lighten_only,
+    "overlay": _overlay,
+    "hard_light": _hard_light,
+    "soft_light": _soft_light,
+    "vivid_light": _in_float32(_vivid_light),
+    "pin_light": _pin_light,
+    "hard_mix": _hard_mix,
+    "grain_extract": _grain_extract,
+    "grain_merge": _grain_merge,
+}
+
+def normal(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "normal", source_alpha)
+def difference(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "difference", source_alpha)
+def multiply(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "multiply", source_alpha)
+def divide(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "divide", source_alpha)
+def addition(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "addition", source_alpha)
+def linear_light(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "linear_light", source_alpha)
+def vivid_light(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "vivid_light", source_alpha)
+def pin_light(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "pin_light", source_alpha)
+def hard_mix(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "hard_mix", source_alpha)
+def linear_burn(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "linear_burn", source_alpha)
+def color_dodge(backdrop, source, opacity, source_alpha=None): 
+    return simple_mode(backdrop, source, opacity, "color_dodge", source_alpha) 
+def color_burn(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "color_burn", source_alpha)
+def exclusion(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "exclusion", source_alpha)
+def subtract(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "subtract", source_alpha)
+def screen(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "screen", source_alpha)
+def soft_light(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "soft_light", source_alpha)
+def hard_light(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "hard_light", source_alpha)
+def overlay(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "overlay", source_alpha)
+def grain_extract(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "grain_extract", source_alpha)
+def grain_merge(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "grain_merge", source_alpha)
+def darken_only(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "darken_only", source_alpha)
+def lighten_only(backdrop, source, opacity, source_alpha=None):
+    return simple_mode(backdrop, source, opacity, "lighten_only", source_alpha)
 
 modes = {
     "difference": difference, 
@@ -318,4 +578,45 @@ modes = {
     "saturation": saturation,
     "color": color,
     "luminosity": luminance
-}
\ No newline at end of file
+}
+
+# Blend modes whose blend does not depend on opacity or alpha, as (raw blend, composite) pairs.
+# The raw blend is what BlendModes caches; for the HSV modes it is the pair of converted layers.
+simple_mode_kernels = {
+    "difference": "difference",
+    "exclusion": "exclusion",
+    "normal": "normal",
+    "screen": "screen",
+    "soft light": "soft_light",
+    "lighten": "lighten_only",
+    "dodge": "color_dodge",
+    "color dodge": "color_dodge",
+    "linear burn": "linear_burn",
+    "linear dodge (add)": "addition",
+    "linear light": "linear_light",
+    "vivid light": "vivid_light",
+    "pin light": "pin_light",
+    "hard mix": "hard_mix",
+    "darken": "darken_only",
+    "multiply": "multiply",
+    "color burn": "color_burn",
+    "hard light": "hard_light",
+    "subtract": "subtract",
+    "grain extract": "grain_extract",
+    "grain merge": "grain_merge",
+    "divide": "divide",
+    "overlay": "overlay",
+}
+
+raw_modes = {name: (partial(simple_blend, mode=kernel), composite) for name, kernel in simple_mode_kernels.items()}
+raw_modes.update({
+    "darker color": (partial(darker_lighter_blend, type="dark"), composite),
+    "lighter color": (partial(darker_lighter_blend, type="light"), composite),
+    "hue": (hsv_pair, partial(composite_hsv, channel="hue")),
+    "saturation": (hsv_pair, partial(composite_hsv, channel="saturation")),
+    "color": (hsv_pair, partial(composite_hsv, channel="color")),
+    "luminosity": (hsv_pair, partial(composite_hsv, channel="luminance")),
+})
+
+blend_cache = LRUCache(max_entries=8, max_bytes=2 * 1024 ** 3)
+noise_cache = LRUCache(max_entries=4, max_bytes=256 * 1024 ** 2)
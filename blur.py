@@ -4,12 +4,65 @@
 @nickname: Virtuoso Pack - Blur
 @description: This extension provides blur nodes.
 """
+import math
 import torch
+import torch.nn.functional as F
+from .precision import is_reduced
 import cv2
 import numpy as np
-from blurgenerator import motion_blur, motion_blur_with_depth_map, \
-                          lens_blur, lens_blur_with_depth_map, \
-                          gaussian_blur, gaussian_blur_with_depth_map
+from .cache import LRUCache
+
+# 'exact' convolves with the Gaussian kernel. 'fast' approximates it with three box blurs, at a cost
+# that doesn't depend on the kernel size.
+gaussian_modes = ["exact", "fast"]
+FAST_GAUSSIAN_TAPS = 64
+
+# 'layers' blurs each depth band of the depth map nodes by its own amount. 'continuous' gives every
+# pixel its own amount, from a few blurs at amounts spread over the depth range, interpolated per
+# pixel, or from box blurs of varying width in the Gaussian node's fast mode.
+depth_modes = ["layers", "continuous"]
+DEPTH_PYRAMID_LEVELS = 8
+
+# Kernels with more taps than this are convolved through the FFT. Spatial convolution costs about
+# one multiply-add per tap and pixel, and the FFT about the same at any kernel size, which on a
+# 1080p frame overtakes spatial convolution at around 150 taps.
+FFT_MIN_TAPS = 150
+# Frames are sent through the FFT in groups whose spectra take up to about this much memory
+FFT_CHUNK_BYTES = 1024 ** 3
+
+# 'kernel' convolves with blurgenerator's rasterized motion kernel. 'line' averages along the line
+# through each pixel with running sums, at a cost that doesn't depend on the blur size.
+motion_engines = ["kernel", "line"]
+
+# Lens blur kernels by radius, component count and device, shared by every call
+lens_kernel_cache = LRUCache(max_entries=16, max_bytes=1024 ** 3)
+
+# Parameters a, b, A and B of the complex Gaussian components of the lens blur kernel for 1 to 6
+# components, from http://yehar.com/blog/?p=1495 (as used by blurgenerator), and the scales that
+# bring each set's disc to roughly the requested radius
+lens_kernel_params = [
+    [[0.862325, 1.624835, 0.767583, 1.862321]],
+    [[0.886528, 5.268909, 0.411259, -0.548794],
+     [1.960518, 1.558213, 0.513282, 4.56111]],
+    [[2.17649, 5.043495, 1.621035, -2.105439],
+     [1.019306, 9.027613, -0.28086, -0.162882],
+     [2.81511, 1.597273, -0.366471, 10.300301]],
+    [[4.338459, 1.553635, -5.767909, 46.164397],
+     [3.839993, 4.693183, 9.795391, -15.227561],
+     [2.791880, 8.178137, -3.048324, 0.302959],
+     [1.342190, 12.328289, 0.010001, 0.244650]],
+    [[4.892608, 1.685979, -22.356787, 85.91246],
+     [4.71187, 4.998496, 35.918936, -28.875618],
+     [4.052795, 8.244168, -13.212253, -1.578428],
+     [2.929212, 11.900859, 0.507991, 1.816328],
+     [1.512961, 16.116382, 0.138051, -0.01]],
+    [[5.143778, 2.079813, -82.326596, 111.231024],
+     [5.612426, 6.153387, 113.878661, 58.004879],
+     [5.982921, 9.802895, 39.479083, -162.028887],
+     [6.505167, 11.059237, -71.286026, 95.027069],
+     [3.869579, 14.81052, 1.405746, -3.704914],
+     [2.201904, 19.032909, -0.152784, -0.107988]]]
+lens_kernel_scales = [1.4, 1.2, 1.2, 1.2, 1.2, 1.2]
 
 class MotionBlur:
     
@@ -36,6 +89,9 @@ class MotionBlur:
                     "step": 0.1,
                     "round": 0.01, 
                     "display": "number"})
+            },
+            "optional": {
+                "engine": (motion_engines,),
             }
         }
 
@@ -43,8 +99,8 @@ class MotionBlur:
     FUNCTION = "do_blur"
     CATEGORY = "Virtuoso/Blur"
 
-    def do_blur(self, image, size, angle):
-        return blur(image, "motion", size=size, angle=angle)  
+    def do_blur(self, image, size, angle, engine="kernel"):
+        return (with_alpha(image, motion_blur(image[..., :3], size, angle, engine)),)
 
 class LensBlur:
     
@@ -86,7 +142,7 @@ class LensBlur:
     CATEGORY = "Virtuoso/Blur"
 
     def do_blur(self, image, radius, components, exposure_gamma):
-        return blur(image, "lens", radius=radius, components=components, exposure_gamma=exposure_gamma)
+        return (with_alpha(image, lens_blur(image[..., :3], radius, components, exposure_gamma)),)
 
 class GaussianBlur:
     
@@ -114,7 +170,8 @@ class GaussianBlur:
     CATEGORY = "Virtuoso/Blur"
 
     def do_blur(self, image, amount):
-        return blur(image, "gaussian", amount=amount)
+        # At GAUSSIAN_SIGMA the kernel never has enough taps for fast mode to pay off, so the blur is always exact
+        return (with_alpha(image, gaussian_blur(image[..., :3], amount, GAUSSIAN_SIGMA)),)
     
 class MotionBlurDepth:
     
@@ -156,6 +213,10 @@ class MotionBlurDepth:
                     "step": 1,
                     "round": 1, 
                     "display": "number"})
+            },
+            "optional": {
+                "depth_mode": (depth_modes,),
+                "engine": (motion_engines,),
             }
         }
 
@@ -163,8 +224,9 @@ class MotionBlurDepth:
     FUNCTION = "do_blur"
     CATEGORY = "Virtuoso/Blur"
 
-    def do_blur(self, image, depth_map, angle, num_layers, min_blur, max_blur):
-        return blur(image, "motion_depth", depth_map=depth_map, angle=angle, num_layers=num_layers, min_blur=min_blur, max_blur=max_blur)  
+    def do_blur(self, image, depth_map, angle, num_layers, min_blur, max_blur, depth_mode="layers", engine="kernel"):
+        blurred = depth_blur(image[..., :3], depth_map, lambda x, amount: motion_blur(x, amount, angle, engine), num_layers, min_blur, max_blur, depth_mode)
+        return (with_alpha(image, blurred),)
 
 class LensBlurDepth:
     
@@ -213,6 +275,9 @@ class LensBlurDepth:
                     "step": 1,
                     "round": 1, 
                     "display": "number"})
+            },
+            "optional": {
+                "depth_mode": (depth_modes,),
             }
         }
 
@@ -220,8 +285,9 @@ class LensBlurDepth:
     FUNCTION = "do_blur"
     CATEGORY = "Virtuoso/Blur"
 
-    def do_blur(self, image, depth_map, components, exposure_gamma, num_layers, min_blur, max_blur):
-        return blur(image, "lens_depth", depth_map=depth_map, components=components, exposure_gamma=exposure_gamma, num_layers=num_layers, min_blur=min_blur, max_blur=max_blur)
+    def do_blur(self, image, depth_map, components, exposure_gamma, num_layers, min_blur, max_blur, depth_mode="layers"):
+        blurred = depth_blur(image[..., :3], depth_map, lambda x, amount: lens_blur(x, amount, components, exposure_gamma), num_layers, min_blur, max_blur, depth_mode)
+        return (with_alpha(image, blurred),)
 
 class GaussianBlurDepth:
     
@@ -263,6 +329,10 @@ class GaussianBlurDepth:
                     "step": 1,
                     "round": 1, 
                     "display": "number"})
+            },
+            "optional": {
+                "mode": (gaussian_modes,),
+                "depth_mode": (depth_modes,),
             }
         }
 
@@ -270,54 +340,852 @@ class GaussianBlurDepth:
     FUNCTION = "do_blur"
     CATEGORY = "Virtuoso/Blur"
 
-    def do_blur(self, image, depth_map, sigma, num_layers, min_blur, max_blur):
-        return blur(image, "gaussian_depth",  depth_map=depth_map, sigma=sigma, num_layers=num_layers, min_blur=min_blur, max_blur=max_blur)
+    def do_blur(self, image, depth_map, sigma, num_layers, min_blur, max_blur, mode="exact", depth_mode="layers"):
+        if depth_mode == "continuous" and mode == "fast":
+            amounts = depth_amounts(depth_map, image.shape[0], min_blur, max_blur)
+            return (with_alpha(image, variable_gaussian_blur(image[..., :3], amounts, sigma)),)
+        blurred = depth_blur(image[..., :3], depth_map, lambda x, amount: gaussian_blur(x, amount, sigma, mode), num_layers, min_blur, max_blur, depth_mode)
+        return (with_alpha(image, blurred),)
+
+
+class BlurStack:
+    """
+    Blurred copies of a batch at increasing amounts, as passed from the blur stack nodes to Focus Blur Stack.
+
+    Attributes:
+        levels (List[torch.Tensor]): The color channels of the batch, first as they are and then blurred
+            at each amount, each with shape [batch size, height, width, 3].
+        amounts (List[int]): Blur amount of each level, 0 for the first.
+        alpha (torch.Tensor): The alpha channel of the batch, with shape [batch size, height, width, 1], or None.
+    """
+    def __init__(self, levels, amounts, alpha=None):
+        self.levels = levels
+        self.amounts = amounts
+        self.alpha = alpha
+
+
+class GaussianBlurStack:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "image": ("IMAGE",),
+                "sigma": ("INT", {
+                    "default": 5,
+                    "min": 1,
+                    "max": 100,
+                    "step": 1,
+                    "round": 1, 
+                    "display": "number"}),
+                "max_blur": ("INT", {
+                    "default": 100,
+                    "min": 1,
+                    "max": 100,
+                    "step": 1,
+                    "round": 1, 
+                    "display": "number"}),
+                "levels": ("INT", {
+                    "default": 8,
+                    "min": 2,
+                    "max": 32,
+                    "step": 1,
+                    "round": 1, 
+                    "display": "number"})
+            },
+            "optional": {
+                "mode": (gaussian_modes,),
+            }
+        }
+
+    RETURN_TYPES = ("BLUR_STACK",)
+    FUNCTION = "do_stack"
+    CATEGORY = "Virtuoso/Blur"
+
+    def do_stack(self, image, sigma, max_blur, levels, mode="exact"):
+        """
+        Blurs an image once at each of a few Gaussian kernel sizes, for Focus Blur Stack.
+
+        Args:
+            image (torch.Tensor): Input image tensor with shape [batch size, height, width, num color channels].
+            sigma (int): Standard deviation of the Gaussian, as in Gaussian Blur with Depth Map.
+            max_blur (int): Largest kernel size.
+            levels (int): Number of blurred levels, spaced geometrically from 1 to max_blur.
+            mode (str): 'exact' or 'fast', as in Gaussian Blur.
+
+        Returns:
+            Tuple[BlurStack]: The blur stack.
+        """
+        return (blur_stack(image, lambda x, amount: gaussian_blur(x, amount, sigma, mode), max_blur, levels),)
+
+class LensBlurStack:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "image": ("IMAGE",),
+                "components": ("INT", {
+                    "default": 4,
+                    "min": 1,
+                    "max": 6,
+                    "step": 1,
+                    "round": 1, 
+                    "display": "number"}),
+                "exposure_gamma": ("FLOAT", {
+                    "default": 2,
+                    "min": -100,
+                    "max": 100,
+                    "step": 0.01,
+                    "round": 0.01, 
+                    "display": "number"}),
+                "max_blur": ("INT", {
+                    "default": 100,
+                    "min": 1,
+                    "max": 100,
+                    "step": 1,
+                    "round": 1, 
+                    "display": "number"}),
+                "levels": ("INT", {
+                    "default": 8,
+                    "min": 2,
+                    "max": 32,
+                    "step": 1,
+                    "round": 1, 
+                    "display": "number"})
+            }
+        }
+
+    RETURN_TYPES = ("BLUR_STACK",)
+    FUNCTION = "do_stack"
+    CATEGORY = "Virtuoso/Blur"
 
+    def do_stack(self, image, components, exposure_gamma, max_blur, levels):
+        """
+        Blurs an image once at each of a few lens blur radii, for Focus Blur Stack.
 
-def blur(image, type, depth_map=None, **kwargs):
+        Args:
+            image (torch.Tensor): Input image tensor with shape [batch size, height, width, num color channels].
+            components (int): Number of lens components, as in Lens Blur.
+            exposure_gamma (float): Exposure power, as in Lens Blur.
+            max_blur (int): Largest radius.
+            levels (int): Number of blurred levels, spaced geometrically from 1 to max_blur.
 
-    if type in ["lens_depth", "gaussian_depth", "motion_depth"]:
-        if depth_map.shape[3] == 4:
-            depth_map = depth_map[:, :, :, :3]  # Remove alpha channel if it exists
+        Returns:
+            Tuple[BlurStack]: The blur stack.
+        """
+        return (blur_stack(image, lambda x, amount: lens_blur(x, amount, components, exposure_gamma), max_blur, levels),)
 
-        # If batch size of depth_map does not match with image, use the first depth_map for all images
-        if depth_map.shape[0] != image.shape[0]:
-            depth_map = depth_map[0].unsqueeze(0).repeat(image.shape[0], 1, 1, 1)
+class FocusBlurStack:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "blur_stack": ("BLUR_STACK",),
+                "depth_map": ("IMAGE",),
+                "focus_distance": ("FLOAT", {
+                    "default": 0.5,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "round": 0.001, 
+                    "display": "number"}),
+                "aperture": ("FLOAT", {
+                    "default": 100.0,
+                    "min": 0.0,
+                    "max": 1000.0,
+                    "step": 0.1,
+                    "round": 0.01, 
+                    "display": "number"})
+            }
+        }
 
-    if image.shape[3] == 4:
-        original_alpha = image[:, :, :, 3]
-        image = image[:, :, :, :3]
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "do_focus"
+    CATEGORY = "Virtuoso/Blur"
+
+    def do_focus(self, blur_stack, depth_map, focus_distance, aperture):
+        """
+        Brings one depth of a blur stack into focus, blurring the rest by their distance from it.
+
+        Each pixel's blur amount is aperture * |depth - focus_distance|, and the pixel is interpolated
+        between the two levels of the stack around that amount, so no blur is computed here. A stack of a
+        single image can be focused with a batch of depth maps, and one depth map used for a whole batch.
+
+        Args:
+            blur_stack (BlurStack): The stack, from Gaussian Blur Stack or Lens Blur Stack.
+            depth_map (torch.Tensor): Depth map, with the lighter areas farther away.
+            focus_distance (float): Depth in focus, from 0 (black in the depth map) to 1 (white).
+            aperture (float): Blur amount at a depth difference of 1. Amounts beyond the stack's largest get its most blurred level.
+
+        Returns:
+            Tuple[torch.Tensor]: The focused image in a tuple.
+        """
+        batch_size = max(blur_stack.levels[0].shape[0], depth_map.shape[0])
+        if blur_stack.levels[0].shape[0] not in (1, batch_size):
+            raise ValueError(f"Focus Blur Stack needs a stack of one image or of as many as the depth maps, got {blur_stack.levels[0].shape[0]} and {depth_map.shape[0]}")
+        amounts = (depth_gray(depth_map, batch_size).float() - focus_distance).abs_().mul_(aperture)
+        levels = (level.expand(batch_size, -1, -1, -1) for level in blur_stack.levels)
+        focused = interpolate_levels(levels, blur_stack.amounts, amounts.to(blur_stack.levels[0].device))
+        focused = focused.to(blur_stack.levels[0].dtype)
+        if blur_stack.alpha is not None:
+            focused = torch.cat((focused, blur_stack.alpha.expand(batch_size, -1, -1, -1)), dim=-1)
+        return (focused,)
+
+
+## The blurs work on the whole batch in float, on the image's device.
+
+# The Gaussian Blur node's amount is the kernel size. As in blurgenerator, sigma is fixed.
+GAUSSIAN_SIGMA = 5
+
+def with_alpha(image, blurred):
+    # Puts the alpha channel of image, if any, back on the blurred color channels
+    if image.shape[-1] == 4:
+        return torch.cat((blurred, image[..., 3:]), dim=-1)
+    return blurred
+
+def gaussian_kernel(kernel_size, sigma, dtype=torch.float32, device=None):
+    """
+    A normalized 1D Gaussian kernel, sampled like cv2.getGaussianKernel.
+
+    Even sizes are rounded up to the next odd one, as blurgenerator does for cv2. A sigma of 0 or
+    less is derived from the size with cv2's rule, 0.3 * ((size - 1) * 0.5 - 1) + 0.8.
+
+    Args:
+        kernel_size (int): Number of taps.
+        sigma (float): Standard deviation, in pixels.
+
+    Returns:
+        torch.Tensor: The kernel, with shape [kernel size].
+    """
+    if kernel_size % 2 == 0:
+        kernel_size += 1
+    if sigma <= 0:
+        sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+    x = torch.arange(kernel_size, dtype=torch.float64) - (kernel_size - 1) / 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return (kernel / kernel.sum()).to(dtype=dtype, device=device)
+
+def pad2d(x, left, right, top, bottom, border="reflect"):
+    """
+    Pads the last two dims of a tensor with one of cv2's borders.
+
+    Args:
+        x (torch.Tensor): Tensor with shape [..., height, width].
+        left, right, top, bottom (int): Pad widths.
+        border (str): 'reflect' for cv2's default, reflect 101 (dcb|abcd|cba), or 'replicate' (aaa|abcd|ddd).
+
+    Returns:
+        torch.Tensor: The padded tensor.
+    """
+    height, width = x.shape[-2:]
+    if border == "replicate":
+        return F.pad(x, (left, right, top, bottom), mode="replicate")
+    # F.pad only reflects once, so borders wider than the image are built from indices instead
+    if max(top, bottom) < height and max(left, right) < width:
+        return F.pad(x, (left, right, top, bottom), mode="reflect")
+    return x.index_select(-2, reflect_indices(height, top, bottom, x.device)).index_select(-1, reflect_indices(width, left, right, x.device))
+
+def reflect_indices(length, before, after, device):
+    index = torch.arange(-before, length + after, device=device).abs_()
+    if length == 1:
+        return index.zero_()
+    period = 2 * (length - 1)
+    index.remainder_(period)
+    return torch.where(index >= length, period - index, index)
+
+def reflect_pad_dim(x, pad, dim):
+    # Reflect 101 padding along a single dim. The edges are copied from flipped slices, which is much
+    # faster than gathering the whole padded tensor by index.
+    length = x.shape[dim]
+    if pad >= length:
+        return x.index_select(dim, reflect_indices(length, pad, pad, x.device))
+    padded = x.new_empty(x.shape[:dim] + (length + 2 * pad,) + x.shape[dim + 1:])
+    padded.narrow(dim, pad, length).copy_(x)
+    padded.narrow(dim, 0, pad).copy_(x.narrow(dim, 1, pad).flip(dim))
+    padded.narrow(dim, pad + length, pad).copy_(x.narrow(dim, length - 1 - pad, pad).flip(dim))
+    return padded
+
+def separable_blur(image, kernel):
+    """
+    Convolves each channel of a batch with a 1D kernel down the columns and then along the rows.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        kernel (torch.Tensor): Odd-sized 1D kernel on the device of image.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape and dtype of image. Borders are reflected as in cv2.
+    """
+    # A [batch, height, width, channels] tensor seen as [batch, channels, height, width] is in the
+    # channels_last memory format, which conv2d takes as it is. Each channel is its own group.
+    # Reduced-precision images are convolved in float32, which CPU convolution handles far faster
+    # and which keeps the taps from being summed in half precision.
+    pad = kernel.shape[0] // 2
+    x = image.permute(0, 3, 1, 2)
+    x = pad2d(x.float() if is_reduced(x) else x, pad, pad, pad, pad)
+    kernel = kernel.to(x.dtype)
+    channels = x.shape[1]
+    x = F.conv2d(x, kernel.view(1, 1, -1, 1).repeat(channels, 1, 1, 1), groups=channels)
+    x = F.conv2d(x, kernel.view(1, 1, 1, -1).repeat(channels, 1, 1, 1), groups=channels)
+    return x.permute(0, 2, 3, 1).to(image.dtype)
+
+def gaussian_blur(image, kernel_size, sigma, mode="exact"):
+    # cv2.GaussianBlur with a square kernel, in float and on the whole batch
+    if kernel_size <= 1:
+        return image.clone()
+    kernel = gaussian_kernel(kernel_size, sigma, torch.float64)
+
+    # Taps too small to change the result (below 1e-6 in total) are dropped, so that a large
+    # kernel size with a small sigma costs no more than the sigma needs
+    tail = (kernel.cumsum(0) < 5e-7).sum().item()
+    taps = kernel[tail:len(kernel) - tail]
+
+    # In fast mode, a kernel that spans at least 3 sigmas each way is close enough to a whole
+    # Gaussian for box blurs to stand in for it. Box blurs cost about as much as convolving with
+    # FAST_GAUSSIAN_TAPS taps, so smaller kernels are convolved exactly, as are kernels cut off
+    # closer to the center.
+    if mode == "fast" and sigma >= 3 and len(kernel) >= 6 * sigma and len(taps) > FAST_GAUSSIAN_TAPS:
+        x = torch.arange(len(kernel), dtype=torch.float64) - len(kernel) // 2
+        return iterated_box_blur(image, (kernel * x ** 2).sum().sqrt().item())
+    return separable_blur(image, taps.to(image.device))
+
+def box_sizes(sigma, passes=3):
+    """
+    Widths of boxes whose repeated blur approximates a Gaussian.
+
+    The widths are odd, and two consecutive odd widths are mixed so that the total variance of the
+    passes is as close as possible to sigma ** 2 (see Kovesi, "Fast Almost-Gaussian Filtering").
+
+    Args:
+        sigma (float): Standard deviation of the Gaussian, in pixels.
+        passes (int): Number of box blurs.
+
+    Returns:
+        List[int]: One width per pass.
+    """
+    ideal = (12 * sigma ** 2 / passes + 1) ** 0.5
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    lower = max(lower, 1)
+    # Number of passes at the lower width, from passes * (w ** 2 - 1) / 12 = sigma ** 2
+    count = round((12 * sigma ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    count = min(max(count, 0), passes)
+    return [lower] * count + [lower + 2] * (passes - count)
+
+def iterated_box_blur(image, sigma, passes=3):
+    """
+    Approximates a Gaussian blur with box blurs computed from running sums.
+
+    Each box blur is the difference of two entries of a running sum (a summed-area table, one axis
+    at a time) down the columns and then along the rows, so it costs the same at any width. Borders
+    are reflected as in cv2. Reduced-precision images are summed in float32.
+
+    For a Gaussian with a sigma of 3 or more, cut off at 3 sigmas or further, the result deviates
+    from exact convolution by at most 0.04 on any 0..1 image, and by at most 0.01 at a hard edge
+    between black and white. On photographic content it is much less.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        sigma (float): Standard deviation of the Gaussian to approximate, in pixels.
+        passes (int): Number of box blurs.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape and dtype of image.
+    """
+    x = image.float() if is_reduced(image) else image
+    for width in box_sizes(sigma, passes):
+        if width > 1:
+            x = box_blur(box_blur(x, width, dim=1), width, dim=2)
+    return x.to(image.dtype)
+
+def box_blur(x, width, dim):
+    # Mean over an odd window along one dim of the reflect-padded input. With running sums s of the
+    # padded input, out[i] = (s[i + width - 1] - s[i - 1]) / width, and out[0] = s[width - 1] / width.
+    # A float32 running sum keeps the error of each mean to about 1e-5.
+    length = x.shape[dim]
+    running = reflect_pad_dim(x, width // 2, dim).cumsum_(dim)
+    out = torch.empty_like(x)
+    out.narrow(dim, 0, 1).copy_(running.narrow(dim, width - 1, 1))
+    torch.sub(running.narrow(dim, width, length - 1), running.narrow(dim, 0, length - 1), out=out.narrow(dim, 1, length - 1))
+    return out.div_(width)
+
+def convolve2d(image, kernel, border="reflect", engine="auto"):
+    """
+    Filters each channel of a batch with a 2D kernel, like cv2.filter2D.
+
+    The kernel is anchored at its center (rounded down for even sizes) and applied as a correlation,
+    as in cv2. Rows and columns of zeros around the kernel are cropped off first, so that e.g. a
+    horizontal line kernel costs only its length. Kernels with more than FFT_MIN_TAPS taps are
+    applied through the FFT (see fft_correlate), which costs the same at any kernel size.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        kernel (torch.Tensor): Kernel with shape [kernel height, kernel width].
+        border (str): 'reflect' (cv2's default, reflect 101) or 'replicate'.
+        engine (str): 'auto' to pick by kernel size, 'spatial' or 'fft'.
+
+    Returns:
+        torch.Tensor: The filtered images, with the shape and dtype of image.
+    """
+    kernel = kernel.to(device=image.device, dtype=torch.float32)
+    rows = kernel.any(dim=1).nonzero().flatten().tolist()
+    columns = kernel.any(dim=0).nonzero().flatten().tolist()
+    if not rows:
+        return torch.zeros_like(image)
+
+    # Each output pixel reads the input from (anchor - first tap) before it to (last tap - anchor)
+    # after it. A cropped kernel can lie entirely on one side of the anchor, so a negative border
+    # becomes a crop of the input.
+    height, width = image.shape[1:3]
+    top, bottom = kernel.shape[0] // 2 - rows[0], rows[-1] - kernel.shape[0] // 2
+    left, right = kernel.shape[1] // 2 - columns[0], columns[-1] - kernel.shape[1] // 2
+    kernel = kernel[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+    x = image.permute(0, 3, 1, 2)
+    x = x.float() if is_reduced(x) else x
+    x = pad2d(x, max(left, 0), max(right, 0), max(top, 0), max(bottom, 0), border)
+    x = x[..., max(-top, 0):max(-top, 0) + height + top + bottom, max(-left, 0):max(-left, 0) + width + left + right]
+
+    if engine == "fft" or (engine == "auto" and kernel.numel() > FFT_MIN_TAPS):
+        out = fft_correlate(x, kernel)
+    else:
+        channels = x.shape[1]
+        out = F.conv2d(x, kernel.to(x.dtype).expand(channels, 1, -1, -1), groups=channels)
+    return out.permute(0, 2, 3, 1).to(image.dtype)
+
+def fft_correlate(x, kernel):
+    """
+    Correlates padded images with a kernel by multiplying their spectra.
+
+    Both are zero-padded to a common size with only small prime factors, which the FFT handles
+    fastest. The size is at least that of the padded images, so the wrap-around of the circular
+    correlation only reaches outputs that are cropped off. Frames are processed in groups of up to
+    FFT_CHUNK_BYTES of spectra.
+
+    Args:
+        x (torch.Tensor): Padded images with shape [batch size, channels, height + kernel height - 1, width + kernel width - 1].
+        kernel (torch.Tensor): Kernel with shape [kernel height, kernel width].
+
+    Returns:
+        torch.Tensor: The valid part of the correlation, with shape [batch size, channels, height, width].
+    """
+    batch, channels, padded_height, padded_width = x.shape
+    height, width = padded_height - kernel.shape[0] + 1, padded_width - kernel.shape[1] + 1
+    size = (fft_size(padded_height), fft_size(padded_width))
+
+    # Correlating with the kernel is multiplying by the conjugate of its spectrum
+    kernel_spectrum = torch.fft.rfft2(kernel.float(), s=size).conj()
+    frames = max(1, FFT_CHUNK_BYTES // (channels * size[0] * (size[1] // 2 + 1) * 8))
+
+    out = x.new_empty((batch, channels, height, width), dtype=torch.float32)
+    for start in range(0, batch, frames):
+        chunk = x[start:start + frames].float()
+        spectrum = torch.fft.rfft2(chunk, s=size).mul_(kernel_spectrum)
+        out[start:start + frames] = torch.fft.irfft2(spectrum, s=size)[..., :height, :width]
+    return out
+
+def fft_size(n):
+    # The smallest size of at least n whose only prime factors are 2, 3 and 5
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+def motion_kernel(size, angle):
+    # blurgenerator's motion kernel: a horizontal line through the center of a size x size square,
+    # rotated by angle degrees with bilinear interpolation and normalized
+    kernel = np.zeros((size, size), dtype=np.float32)
+    kernel[(size - 1) // 2, :] = 1
+    kernel = cv2.warpAffine(kernel, cv2.getRotationMatrix2D((size / 2 - 0.5, size / 2 - 0.5), angle, 1.0), (size, size))
+    return torch.from_numpy(kernel / kernel.sum())
+
+def motion_blur(image, size, angle, engine="kernel"):
+    # blurgenerator's motion blur (cv2.filter2D with motion_kernel), or the same streak as a line
+    # integral (see line_blur), on the whole batch in float
+    if size <= 1:
+        return image.clone()
+    if engine == "line":
+        # motion_kernel's line is half a pixel above the center of an even-sized kernel, which is
+        # itself half a pixel up and left of cv2's anchor. The line integral is shifted to match.
+        shift = (0.0, 0.0)
+        if round(size) % 2 == 0:
+            radians = math.radians(angle)
+            shift = (-0.5 - 0.5 * math.sin(radians), -0.5 - 0.5 * math.cos(radians))
+        return line_blur(image, size, angle, shift)
+    return convolve2d(image, motion_kernel(size, angle))
+
+def line_blur(image, length, angle, shift=(0.0, 0.0)):
+    """
+    Averages each pixel over a line of the given length, at a cost that doesn't depend on the length.
+
+    The line runs at angle degrees counterclockwise from the horizontal, as in motion_kernel. The
+    image is sheared so that the lines become rows (see sheared_line_blur), averaged along the rows
+    with running sums, and sheared back. Lines closer to vertical than to horizontal are handled the
+    same way on the transposed image. Borders are reflected as in cv2.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        length (float): Length of the line, in pixels.
+        angle (float): Angle of the line, in degrees.
+        shift (Tuple[float]): Offset of the line's center from the pixel, in pixels right and down.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape and dtype of image.
+    """
+    # Direction of the line, with y pointing down as in the image
+    dx, dy = math.cos(math.radians(angle)), -math.sin(math.radians(angle))
+    x = image.permute(0, 3, 1, 2)
+    x = x.float() if is_reduced(x) else x
+    if abs(dx) >= abs(dy):
+        out = sheared_line_blur(x, dy / dx, length * abs(dx), shift)
     else:
-        original_alpha = None
-
-    blurred_images = []
-    for i, img in enumerate(image):
-        img_cv2 = img.cpu().numpy()
-        img_cv2 = (img_cv2 * 255).astype(np.uint8)
-        img_cv2 = cv2.cvtColor(img_cv2, cv2.COLOR_RGB2BGR)
-
-        if type == "gaussian":
-            blurred_img_cv2 = gaussian_blur(img_cv2, kwargs["amount"])
-        elif type == "lens":
-            blurred_img_cv2 = lens_blur(img_cv2, kwargs["radius"], kwargs["components"], kwargs["exposure_gamma"])
-        elif type == "motion":
-            blurred_img_cv2 = motion_blur(img_cv2, kwargs["size"], kwargs["angle"])
-        else: #depth map blur
-            depth_map_img = depth_map[i].cpu().numpy()
-            depth_map_img = (depth_map_img * 255).astype(np.uint8)
-            if type == "motion_depth":
-                blurred_img_cv2 = motion_blur_with_depth_map(img_cv2, depth_map=depth_map_img, angle=kwargs["angle"], num_layers=kwargs["num_layers"], min_blur=kwargs["min_blur"], max_blur=kwargs["max_blur"])
-            elif type == "lens_depth":
-                blurred_img_cv2 = lens_blur_with_depth_map(img_cv2, depth_map=depth_map_img, components=kwargs["components"], exposure_gamma=kwargs["exposure_gamma"], num_layers=kwargs["num_layers"], min_blur=kwargs["min_blur"], max_blur=kwargs["max_blur"])
-            elif type == "gaussian_depth":
-                blurred_img_cv2 = gaussian_blur_with_depth_map(img_cv2, depth_map=depth_map_img, sigma=kwargs["sigma"], num_layers=kwargs["num_layers"], min_blur=kwargs["min_blur"], max_blur=kwargs["max_blur"])
-        blurred_img = cv2.cvtColor(blurred_img_cv2, cv2.COLOR_BGR2RGB)
-        blurred_img = torch.from_numpy(blurred_img.astype(np.float32) / 255.0).to(image.device)
-        blurred_images.append(blurred_img)
-
-    final_tensor = torch.stack(blurred_images)
-
-    if original_alpha is not None:
-        final_tensor = torch.cat((final_tensor, original_alpha.unsqueeze(3)), dim=3)
-
-    return (final_tensor, )
\ No newline at end of file
+        out = sheared_line_blur(x.transpose(2, 3), dx / dy, length * abs(dy), shift[::-1]).transpose(2, 3)
+    return out.permute(0, 2, 3, 1).to(image.dtype)
+
+def sheared_line_blur(x, slope, extent, shift=(0.0, 0.0)):
+    """
+    Averages each pixel over a line of slope at most 1, with running sums along the rows.
+
+    Every point (x + t, y + slope * t) of the line through (x, y) has the same u = y - slope * x. In
+    the image resampled at (x, u + slope * x), each column shifted by its own (not necessarily whole)
+    number of rows, the line is therefore a row. It is averaged there with a box as wide as the line
+    spans columns, and each pixel is read back from the row and column of its line's center. Both
+    resamplings interpolate linearly within a column.
+
+    Args:
+        x (torch.Tensor): Images with shape [batch size, channels, height, width].
+        slope (float): Rows per column along the line, from -1 to 1.
+        extent (float): Number of columns the line spans.
+        shift (Tuple[float]): Offset of the line's center from the pixel, in columns and rows.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape of x.
+    """
+    height, width = x.shape[2:]
+    shift_x, shift_y = shift
+    # The image is reflect-padded by the reach of the line each way, plus a pixel for the interpolation
+    pad_x = math.ceil(extent / 2 + abs(shift_x)) + 1
+    pad_y = math.ceil(extent / 2 * abs(slope) + abs(shift_y)) + 1
+    padded = pad2d(x, pad_x, pad_x, pad_y, pad_y)
+
+    # Rows u of the sheared image, from just below the smallest u of a line's center to just above the largest
+    columns = torch.arange(padded.shape[3], dtype=torch.float64)
+    reach = slope * (width - 1)
+    low = pad_y + shift_y - slope * (pad_x + shift_x) - max(reach, 0) - 1
+    u = torch.arange(math.ceil(height + abs(reach)) + 3, dtype=torch.float64) + low
+    sheared = resample_rows(padded, u.view(-1, 1) + slope * columns)
+
+    # Pixel (x, y) of the output is read from the box centered on column x + shift_x, at row
+    # y + shift_y - slope * (x + shift_x) of the blurred rows
+    blurred = fractional_box(sheared, extent, pad_x, shift_x)
+    columns = torch.arange(pad_x, pad_x + width, dtype=torch.float64) + shift_x
+    rows = torch.arange(pad_y, pad_y + height, dtype=torch.float64).view(-1, 1) + shift_y - slope * columns - low
+    return resample_rows(blurred, rows)
+
+def resample_rows(x, rows):
+    # Reads each column j of x [batch, channels, height, width] at the fractional rows rows[:, j],
+    # with linear interpolation. Rows outside x read as 0.
+    height, width = x.shape[2:]
+    columns = torch.linspace(-1, 1, width, dtype=torch.float64) if width > 1 else torch.zeros(1, dtype=torch.float64)
+    grid = torch.stack((columns.expand(rows.shape), rows * (2 / max(height - 1, 1)) - 1), dim=-1)
+    grid = grid.to(device=x.device, dtype=x.dtype).expand(x.shape[0], -1, -1, -1)
+    return F.grid_sample(x, grid, mode="bilinear", padding_mode="zeros", align_corners=True)
+
+def fractional_box(x, width, pad, shift=0.0):
+    # Means over a window of (not necessarily whole) width, centered shift columns from each column of
+    # x but the pad columns at either end. With the pixels seen as cells of width 1, a window's sum is
+    # the difference of the integral of the row at its two ends, which is the running sum interpolated
+    # linearly within a cell. The ends are at the same offsets from every column, so they are slices.
+    count = x.shape[-1] - 2 * pad
+    running = F.pad(x, (1, 0)).cumsum_(-1)
+
+    def integral(offset):
+        position = pad + 0.5 + shift + offset
+        cell = math.floor(position)
+        return torch.lerp(running[..., cell:cell + count], running[..., cell + 1:cell + 1 + count], position - cell)
+
+    return (integral(width / 2) - integral(-width / 2)).div_(width)
+
+def lens_kernel(radius, components, device=None):
+    """
+    The 2D kernel of blurgenerator's lens blur, from the cache when it was made before.
+
+    Each component is a 1D complex Gaussian k, applied down the columns and along the rows, and
+    contributes A * real + B * imaginary part of the result. That is linear in the image, so all
+    components add up to a single real kernel: the sum of A * Re(k k^T) + B * Im(k k^T). The 1D
+    kernels are scaled together so that the 2D kernel sums to 1.
+
+    Args:
+        radius (float): Radius of the bokeh disc, in pixels.
+        components (int): Number of components, 1 to 6. More give a flatter, sharper-edged disc.
+        device (torch.device): Device of the kernel.
+
+    Returns:
+        torch.Tensor: Kernel with shape [2 * ceil(radius) + 1] * 2, float32.
+    """
+    key = (radius, components, device)
+    kernel = lens_kernel_cache.get(key)
+    if kernel is not None:
+        return kernel
+
+    index = max(0, min(components - 1, len(lens_kernel_params) - 1))
+    size = 2 * math.ceil(radius) + 1
+    x = torch.linspace(-radius, radius, size, dtype=torch.float64) * (lens_kernel_scales[index] / radius)
+    kernel = torch.zeros((size, size), dtype=torch.float64)
+    total = 0
+    for a, b, A, B in lens_kernel_params[index]:
+        k = torch.exp(-a * x ** 2) * torch.exp(1j * b * x ** 2)
+        outer = k.unsqueeze(1) * k.unsqueeze(0)
+        kernel += A * outer.real + B * outer.imag
+        # blurgenerator's normalization, the sum of this component's 2D kernel
+        total += A * (k.sum() ** 2).real + B * (k.sum() ** 2).imag
+    kernel /= total
+
+    return lens_kernel_cache.put(key, kernel.to(device=device, dtype=torch.float32))
+
+def lens_blur(image, radius, components, exposure_gamma):
+    """
+    blurgenerator's lens blur, on the whole batch in float.
+
+    The image is raised to exposure_gamma so that bright spots bloom into bokeh discs, convolved with
+    lens_kernel (with replicated borders, through the FFT for all but small radii), and brought back
+    with the inverse power.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        radius (float): Radius of the bokeh disc, in pixels.
+        components (int): Number of kernel components, 1 to 6.
+        exposure_gamma (float): Exposure power. Higher values make highlights dominate the blur.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape and dtype of image.
+    """
+    exposed = image.float().pow(exposure_gamma)
+    blurred = convolve2d(exposed, lens_kernel(radius, components, image.device), border="replicate")
+    # Small negatives come from the negative lobes of the complex kernels
+    return blurred.clamp_min_(0).pow_(1.0 / exposure_gamma).clamp_(0, 1).to(image.dtype)
+
+def depth_gray(depth_map, batch_size):
+    # The depth map as luminance in 0..1, with shape [batch, height, width]. A single depth map is
+    # used for every image of the batch.
+    if depth_map.shape[0] != batch_size:
+        depth_map = depth_map[:1]
+    gray = depth_map[..., :3] @ depth_map.new_tensor([0.299, 0.587, 0.114])
+    return gray.expand(batch_size, -1, -1)
+
+def depth_layers(gray, num_layers, min_blur, max_blur):
+    """
+    Splits each frame's depth range into layers, as blurgenerator's depth map blurs do.
+
+    A frame's range from its smallest to its largest depth is cut into num_layers equal layers, and
+    each layer is blurred by an amount mapped from its lower bound: min_blur at depth 0, max_blur at
+    depth 1. Unlike blurgenerator, the nearest and farthest pixels are inside the first and last
+    layers rather than left black.
+
+    Args:
+        gray (torch.Tensor): Depths in 0..1, with shape [batch size, height, width].
+        num_layers (int): Number of layers per frame.
+        min_blur (int): Blur amount at depth 0.
+        max_blur (int): Blur amount at depth 1.
+
+    Returns:
+        Dict[int, torch.Tensor]: For each blur amount used, a mask of the pixels to blur that much,
+        with shape [batch size, height, width].
+    """
+    low = gray.amin(dim=(1, 2), keepdim=True)
+    step = (gray.amax(dim=(1, 2), keepdim=True) - low) / num_layers
+    layer = ((gray - low) / step.clamp_min(torch.finfo(gray.dtype).tiny)).floor_().clamp_(0, num_layers - 1)
+
+    masks = {}
+    for i in range(num_layers):
+        amounts = (min_blur + (low + i * step) * (max_blur - min_blur)).flatten().int().tolist()
+        in_layer = layer == i
+        for frame, amount in enumerate(amounts):
+            if amount not in masks:
+                masks[amount] = torch.zeros_like(in_layer)
+            masks[amount][frame] |= in_layer[frame]
+    return masks
+
+def layered_blur(image, depth_map, blur_fn, num_layers, min_blur, max_blur):
+    """
+    Blurs each depth layer of a batch by its own amount (see depth_layers).
+
+    Every amount is used to blur all frames that have pixels at that amount in one call, and each
+    pixel is taken from the blur of its layer.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        depth_map (torch.Tensor): Depth maps, one per image or one for all, with shape [batch size, height, width, 3 or 4].
+        blur_fn (callable): Takes images and a blur amount, and returns the blurred images.
+        num_layers (int): Number of layers per frame.
+        min_blur (int): Blur amount at depth 0.
+        max_blur (int): Blur amount at depth 1.
+
+    Returns:
+        torch.Tensor: The blurred images.
+    """
+    out = torch.zeros_like(image)
+    for amount, mask in depth_layers(depth_gray(depth_map, image.shape[0]), num_layers, min_blur, max_blur).items():
+        frames = mask.flatten(1).any(dim=1).nonzero().flatten()
+        if len(frames) == 0:
+            continue
+        blurred = blur_fn(image[frames], amount)
+        out[frames] += blurred * mask[frames].unsqueeze(-1)
+    return out
+
+def depth_blur(image, depth_map, blur_fn, num_layers, min_blur, max_blur, depth_mode="layers"):
+    # Blurs a batch by the amounts of its depth map, in layers or continuously (see depth_modes)
+    if depth_mode == "continuous":
+        return pyramid_blur(image, depth_amounts(depth_map, image.shape[0], min_blur, max_blur), blur_fn)
+    return layered_blur(image, depth_map, blur_fn, num_layers, min_blur, max_blur)
+
+def depth_amounts(depth_map, batch_size, min_blur, max_blur):
+    # The blur amount of each pixel, from min_blur at depth 0 to max_blur at depth 1, with shape
+    # [batch, height, width] in float32. Unlike depth_layers, amounts aren't rounded to a layer's.
+    return depth_gray(depth_map, batch_size).float() * (max_blur - min_blur) + min_blur
+
+def pyramid_blur(image, amounts, blur_fn, levels=DEPTH_PYRAMID_LEVELS):
+    """
+    Blurs each pixel of a batch by its own amount, by interpolating between a few blurred copies.
+
+    The batch is blurred at up to levels amounts, spaced geometrically from the smallest to the
+    largest amount in the batch (so more closely where a step in amount is more visible). Each pixel
+    is interpolated linearly between the two levels around its amount, so that the blur changes
+    smoothly with depth, without the bands of layered_blur, and at the same cost however finely the
+    depth map is graded.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        amounts (torch.Tensor): Blur amount of each pixel, at least 1, with shape [batch size, height, width].
+        blur_fn (callable): Takes images and a whole blur amount, and returns the blurred images.
+        levels (int): Largest number of blurs.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape and dtype of image.
+    """
+    steps = pyramid_steps(amounts.min().item(), amounts.max().item(), levels)
+    # The levels are made one at a time as they are interpolated, so only two are kept at once
+    return interpolate_levels((blur_fn(image, step) for step in steps), steps, amounts).to(image.dtype)
+
+def pyramid_steps(low, high, levels):
+    # Up to levels whole blur amounts from low to high, spaced geometrically (low is at least 1)
+    return sorted({round(low * (high / low) ** (i / max(levels - 1, 1))) for i in range(levels)})
+
+def interpolate_levels(levels, steps, amounts):
+    """
+    Interpolates each pixel between the two blurred levels around its blur amount.
+
+    With levels l and weights t_i = clamp((amount - step_(i-1)) / (step_i - step_(i-1)), 0, 1), the
+    sum l_0 + t_1 * (l_1 - l_0) + t_2 * (l_2 - l_1) + ... telescopes to exactly that interpolation,
+    and only needs the previous level at each step. Amounts beyond the first or last step get that
+    level.
+
+    Args:
+        levels (Iterable[torch.Tensor]): Blurred images with shape [batch size, height, width, channels], one per step.
+        steps (List[float]): Increasing blur amount of each level.
+        amounts (torch.Tensor): Blur amount of each pixel, with shape [batch size, height, width].
+
+    Returns:
+        torch.Tensor: The interpolated images, in float32.
+    """
+    levels = iter(levels)
+    previous = next(levels).float()
+    out = previous.clone()
+    for before, step, level in zip(steps, steps[1:], levels):
+        level = level.float()
+        weight = ((amounts - before) / (step - before)).clamp_(0, 1).unsqueeze(-1)
+        out.addcmul_(level - previous, weight)
+        previous = level
+    return out
+
+def blur_stack(image, blur_fn, max_blur, levels):
+    # The sharp batch, then levels blurs of it at amounts from 1 to max_blur (see pyramid_steps)
+    amounts = pyramid_steps(1, max_blur, levels)
+    blurred = [image[..., :3]] + [blur_fn(image[..., :3], amount) for amount in amounts]
+    return BlurStack(blurred, [0] + amounts, image[..., 3:] if image.shape[-1] == 4 else None)
+
+def variable_gaussian_blur(image, amounts, sigma, passes=3):
+    """
+    Approximates a Gaussian blur whose kernel size changes from pixel to pixel.
+
+    Each pixel's amount is a kernel size, as for gaussian_blur, and is turned into the standard
+    deviation of that (cut off) kernel, interpolated between whole sizes. The blur is then passes
+    box blurs down the columns and along the rows, each as wide at a pixel as that pixel's share of
+    the variance needs (see variable_box_blur). The cost doesn't depend on the amounts.
+
+    Args:
+        image (torch.Tensor): Images with shape [batch size, height, width, channels].
+        amounts (torch.Tensor): Kernel size of each pixel, with shape [batch size, height, width].
+        sigma (float): Standard deviation of the Gaussian at sizes that don't cut it off, in pixels.
+        passes (int): Number of box blurs along each axis.
+
+    Returns:
+        torch.Tensor: The blurred images, with the shape and dtype of image.
+    """
+    # Standard deviation of the kernel for each whole size, 0 for sizes of 1 or less
+    largest = math.ceil(amounts.max().item()) + 1
+    deviations = torch.zeros(largest + 1, dtype=torch.float64)
+    for size in range(2, largest + 1):
+        kernel = gaussian_kernel(size, sigma, torch.float64)
+        x = torch.arange(len(kernel), dtype=torch.float64) - len(kernel) // 2
+        deviations[size] = (kernel * x ** 2).sum().sqrt()
+    deviations = deviations.to(image.device)
+
+    position = amounts.double().clamp(0, largest - 1)
+    whole = position.floor()
+    deviation = torch.lerp(deviations[whole.long()], deviations[whole.long() + 1], position - whole)
+
+    # A box of width w has a variance of (w ** 2 - 1) / 12, and the passes add up to the Gaussian's
+    half = (12 * deviation ** 2 / passes + 1).sqrt_().div_(2).float().unsqueeze(-1)
+    x = image
+    for _ in range(passes):
+        x = variable_box_blur(variable_box_blur(x, half, dim=1), half, dim=2)
+    return x.to(image.dtype)
+
+def variable_box_blur(x, half, dim):
+    # Mean over a window of half-width half[i] (at least 1/2, and not necessarily whole) around each
+    # pixel i along one dim of the reflect-padded input. With the pixels seen as cells of width 1,
+    # the window's sum is the difference of the integral of the input at its two ends, where the
+    # integral is the running sum s, interpolated linearly within a cell. The running sums are
+    # float32 (float64 for a float64 input). Their rounding grows with the length of the row and,
+    # for the narrowest windows of a single pixel, reaches about 0.0005 (an eighth of an 8-bit
+    # step) on rows of 8192 pixels.
+    length = x.shape[dim]
+    pad = math.ceil(half.max().item())
+    padded = reflect_pad_dim(x if x.dtype == torch.float64 else x.float(), pad, dim)
+    half = half.to(padded.dtype)
+    running = padded.new_zeros(padded.shape[:dim] + (padded.shape[dim] + 1,) + padded.shape[dim + 1:])
+    running.narrow(dim, 1, padded.shape[dim]).copy_(padded)
+    running.cumsum_(dim)
+
+    # Cell i of the input spans pad + i to pad + i + 1 of the padded input
+    shape = [1] * x.dim()
+    shape[dim] = length
+    center = torch.arange(length, dtype=padded.dtype, device=x.device).add_(pad + 0.5).view(shape)
+
+    def integral(position):
+        # Indices are computed once per pixel and shared by its channels
+        cell = position.floor()
+        index = cell.long()
+        start, end = running.gather(dim, index.expand(x.shape)), running.gather(dim, index.add_(1).expand(x.shape))
+        return start.lerp_(end, (position - cell).expand(x.shape))
+
+    return ((integral(center + half) - integral(center - half)) / (2 * half)).to(x.dtype)
@@ -0,0 +1,83 @@
+"""
+@author: Chris Freilich
+@title: Virtuoso Pack - Caches
+@nickname: Virtuoso Pack - Caches
+@description: Small in-memory LRU caches shared by the nodes.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+import torch
+
+class LRUCache:
+    """
+    A least-recently-used cache bounded by entry count and, optionally, by the bytes of the tensors it holds.
+
+    Entries can be tied to owner tensors. Only weak references to the owners are kept: an entry is
+    dropped once an owner is freed, and a lookup misses unless the same owner objects are passed in.
+    This way a key built from id() cannot match a different tensor that reuses a freed tensor's id.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def get(self, key, owners=()):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            refs, value, size = entry
+            if len(refs) != len(owners) or any(ref() is not owner for ref, owner in zip(refs, owners)):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, owners=()):
+        size = nbytes(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return value
+        refs = tuple(weakref.ref(owner, lambda _, key=key: self.discard(key)) for owner in owners)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (refs, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+def tensor_owner(tensor):
+    # The tensor a view was taken from. A slice such as image[..., :3] is a new object on every call,
+    # so cache entries are tied to the tensor it views, which lives as long as the node output.
+    return tensor._base if tensor._base is not None else tensor
+
+def tensor_key(tensor):
+    # Identifies a tensor, or a view by its owner and the memory it spans, and its contents:
+    # in-place writes bump the version counter, which views share with their owner
+    return (id(tensor_owner(tensor)), tensor._version, tensor.data_ptr(), tuple(tensor.shape), tuple(tensor.stride()), tensor.dtype, tensor.device)
+
+def nbytes(value):
+    # Memory held by the tensors in a (possibly nested) cache value
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return 0
@@ -7,9 +7,11 @@ SplitRGB and MergeRGB nodes, Hue/Saturation, Hue/Saturation Advanced,
 SolidColorRGB, SolidColorHSV, and Black and White nodes.
 """
 import torch
-from scipy.interpolate import CubicSpline
 import colorsys
 from .hsv import rgb_to_hsv, hsv_to_rgb
+from .lut import build_lut, apply_lut
+from .precision import precision_names, to_precision, restore_precision
+from .tiling import tiled
 
 class SolidColorRGB():
     NAME = "Solid Color RGB"
@@ -320,16 +322,24 @@ class ColorBalance():
                     "round": 0.001, 
                     "display": "number"}),
                 "preserve_luminosity": ("BOOLEAN", {"default": True})
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
             }
         }
 
     def do_color_balance(self, image, lows_cyan_red, lows_magenta_green, lows_yellow_blue, 
                                       mids_cyan_red, mids_magenta_green, mids_yellow_blue,
-                                      highs_cyan_red, highs_magenta_green, highs_yellow_blue, preserve_luminosity):
-        return (color_balance(image, 
-                              [lows_cyan_red, lows_magenta_green, lows_yellow_blue], 
-                              [mids_cyan_red, mids_magenta_green, mids_yellow_blue], 
-                              [highs_cyan_red, highs_magenta_green, highs_yellow_blue], preserve_luminosity=preserve_luminosity), )
+                                      highs_cyan_red, highs_magenta_green, highs_yellow_blue, preserve_luminosity, tile_size=0):
+        lut = color_balance_lut([lows_cyan_red, lows_magenta_green, lows_yellow_blue], 
+                                [mids_cyan_red, mids_magenta_green, mids_yellow_blue], 
+                                [highs_cyan_red, highs_magenta_green, highs_yellow_blue], device=image.device)
+        return (tiled(color_balance, tile_size, image, lut, preserve_luminosity=preserve_luminosity), )
 
 class ColorBalanceAdvanced():
     NAME = "Color Balance Advanced"
@@ -371,51 +381,59 @@ class ColorBalanceAdvanced():
                     "round": 0.001, 
                     "display": "number"}),  
                 "preserve_luminosity": ("BOOLEAN", {"default": True})
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
             }
         }
 
-    def do_color_balance(self, image, brightness_target, cyan_red, magenta_green, yellow_blue, preserve_luminosity):
-        return (color_balance(image, 
-                              [0, 0, 0], 
-                              [cyan_red, magenta_green,yellow_blue], 
-                              [0, 0, 0], 0.15, brightness_target, midtone_max=1, preserve_luminosity=preserve_luminosity), )
+    def do_color_balance(self, image, brightness_target, cyan_red, magenta_green, yellow_blue, preserve_luminosity, tile_size=0):
+        lut = color_balance_lut([0, 0, 0], 
+                                [cyan_red, magenta_green,yellow_blue], 
+                                [0, 0, 0], 0.15, brightness_target, midtone_max=1, device=image.device)
+        return (tiled(color_balance, tile_size, image, lut, preserve_luminosity=preserve_luminosity), )
 
 
-def color_balance(img, shadows, midtones, highlights, shadow_center=0.15, midtone_center=0.5, highlight_center=0.8, shadow_max=0.1, midtone_max=0.3, highlight_max=0.2, preserve_luminosity=False):
-    # Create a copy of the img tensor
-    img_copy = img.clone()
-
-    # Calculate the original luminance if preserve_luminosity is True
-    if preserve_luminosity:
-        original_luminance = 0.2126 * img_copy[..., 0] + 0.7152 * img_copy[..., 1] + 0.0722 * img_copy[..., 2]
-
+def color_balance_lut(shadows, midtones, highlights, shadow_center=0.15, midtone_center=0.5, highlight_center=0.8, shadow_max=0.1, midtone_max=0.3, highlight_max=0.2, device=None):
     # Define the adjustment curves
-    def adjust(x, center, value, max_adjustment):
+    def adjust(center, value, max_adjustment):
         # Scale the adjustment value
         value = value * max_adjustment
-        
-        # Define control points
-        points = torch.tensor([[0, 0], [center, center + value], [1, 1]])
-        
-        # Create cubic spline
-        cs = CubicSpline(points[:, 0], points[:, 1])
-        
-        # Apply the cubic spline to the color channel
-        return torch.clamp(torch.from_numpy(cs(x)), 0, 1)
 
-    # Apply the adjustments to each color channel
-    # shadows, midtones, highlights are lists of length 3 (for R, G, B channels) with values between -1 and 1
-    for i, (s, m, h) in enumerate(zip(shadows, midtones, highlights)):
-        img_copy[..., i] = adjust(img_copy[..., i], shadow_center, s, shadow_max)
-        img_copy[..., i] = adjust(img_copy[..., i], midtone_center, m, midtone_max)
-        img_copy[..., i] = adjust(img_copy[..., i], highlight_center, h, highlight_max)
+        # A cubic spline through (0, 0), (center, center + value) and (1, 1) with not-a-knot ends, which
+        # is what scipy's CubicSpline builds from three points, is the parabola through them
+        curvature = -value / (center * (1 - center))
+        return lambda x: torch.clamp(x + curvature * x * (x - 1), 0, 1)
+
+    # shadows, midtones, highlights are lists of length 3 (for R, G, B channels) with values between -1 and 1.
+    # The three adjustments of each channel are applied in turn, and compiled into one lookup table.
+    curves = []
+    for s, m, h in zip(shadows, midtones, highlights):
+        adjust_shadows = adjust(shadow_center, s, shadow_max)
+        adjust_midtones = adjust(midtone_center, m, midtone_max)
+        adjust_highlights = adjust(highlight_center, h, highlight_max)
+        curves.append(lambda x, a=adjust_shadows, b=adjust_midtones, c=adjust_highlights: c(b(a(x))))
+
+    return build_lut(curves, device=device)
+
+def color_balance(img, lut, preserve_luminosity=False):
+
+    # Apply the adjustment curves to the color channels in one pass
+    balanced = apply_lut(img, lut)
 
     # If preserve_luminosity is True, adjust the RGB values to match the original luminance
     if preserve_luminosity:
-        current_luminance = 0.2126 * img_copy[..., 0] + 0.7152 * img_copy[..., 1] + 0.0722 * img_copy[..., 2]
-        img_copy *= (original_luminance / current_luminance).unsqueeze(-1)
+        original_luminance = 0.2126 * img[..., 0] + 0.7152 * img[..., 1] + 0.0722 * img[..., 2]
+        current_luminance = 0.2126 * balanced[..., 0] + 0.7152 * balanced[..., 1] + 0.0722 * balanced[..., 2]
+        # Black stays black (the curves keep 0 at 0) instead of becoming 0 / 0
+        balanced[..., :3] *= (original_luminance / current_luminance.clamp_min(torch.finfo(current_luminance.dtype).tiny)).unsqueeze(-1)
 
-    return img_copy
+    return balanced
 
 class BlackAndWhite():
     NAME = "Black and White"
@@ -470,61 +488,76 @@ class BlackAndWhite():
                     "step": 0.01,
                     "round": 0.001, 
                     "display": "number"}),                 
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
             }
         }
 
-    def do_black_and_white(self, image, red, green, blue, cyan, magenta, yellow):
-        """
-        Convert a color image to black and white with adjustable color weights.
-
-        Parameters:
-        img (torch.Tensor): Input image tensor with shape [batch size, height, width, number of channels]
-        red (float): Weight for red, range -1.0 to 1.0
-        green (float): Weight for green, range -1.0 to 1.0
-        blue (float): Weight for blue, range -1.0 to 1.0
-        cyan (float): Weight for cyan, range -1.0 to 1.0
-        magenta (float): Weight for magenta, range -1.0 to 1.0
-        yellow (float): Weight for yellow, range -1.0 to 1.0
-
-        Returns:
-        torch.Tensor: Black and white image tensor with values in range 0-1
-        """
-        # Calculate minimum color value across all color channels for each pixel
-        min_c, _ = image.min(dim=-1)
-
-        # Calculate differences between color channels and minimum color value
-        diff = image - min_c.unsqueeze(-1)
-
-        # Create masks for red, green, and blue pixels
-        red_mask = (diff[:, :, :, 0] == 0)
-        green_mask = torch.logical_and((diff[:, :, :, 1] == 0), ~red_mask)
-        blue_mask = ~torch.logical_or(red_mask, green_mask)
-
-        # Calculate c, m, and yel values
-        c, _ = diff[:, :, :, 1:].min(dim=-1)
-        m, _ = diff[:, :, :, [0, 2]].min(dim=-1)
-        yel, _ = diff[:, :, :, :2].min(dim=-1)
-
-        # Calculate luminance using vectorized operations
-        luminance = min_c + red_mask * (c * cyan + (diff[:, :, :, 1] - c) * green + (diff[:, :, :, 2] - c) * blue)
-        luminance += green_mask * (m * magenta + (diff[:, :, :, 0] - m) * red + (diff[:, :, :, 2] - m) * blue)
-        luminance += blue_mask * (yel * yellow + (diff[:, :, :, 0] - yel) * red + (diff[:, :, :, 1] - yel) * green)
-
-        # Clip luminance values to be between 0 and 1
-        luminance = luminance.clamp(0, 1)
-
-        # Add an extra dimension for color channels
-        luminance = luminance.unsqueeze(-1)
-
-        # Convert grayscale to RGB by duplicating the grayscale channel
-        rgb_image = luminance.expand(-1, -1, -1, 3)
-
-        # If the original image had an alpha channel, append it back
-        if image.shape[-1] == 4:
-            alpha_channel = image[:, :, :, 3:]
-            rgb_image = torch.cat((rgb_image, alpha_channel), dim=-1)
-
-        return (rgb_image,)
+    def do_black_and_white(self, image, red, green, blue, cyan, magenta, yellow, tile_size=0, precision="float32"):
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        return (restore_precision(tiled(black_and_white, tile_size, image, red, green, blue, cyan, magenta, yellow), dtype),)
+
+
+def black_and_white(image, red, green, blue, cyan, magenta, yellow):
+    """
+    Convert a color image to black and white with adjustable color weights.
+
+    Parameters:
+    img (torch.Tensor): Input image tensor with shape [batch size, height, width, number of channels]
+    red (float): Weight for red, range -1.0 to 1.0
+    green (float): Weight for green, range -1.0 to 1.0
+    blue (float): Weight for blue, range -1.0 to 1.0
+    cyan (float): Weight for cyan, range -1.0 to 1.0
+    magenta (float): Weight for magenta, range -1.0 to 1.0
+    yellow (float): Weight for yellow, range -1.0 to 1.0
+
+    Returns:
+    torch.Tensor: Black and white image tensor with values in range 0-1
+    """
+    # Calculate minimum color value across all color channels for each pixel
+    min_c, _ = image.min(dim=-1)
+
+    # Calculate differences between color channels and minimum color value
+    diff = image - min_c.unsqueeze(-1)
+
+    # Create masks for red, green, and blue pixels
+    red_mask = (diff[:, :, :, 0] == 0)
+    green_mask = torch.logical_and((diff[:, :, :, 1] == 0), ~red_mask)
+    blue_mask = ~torch.logical_or(red_mask, green_mask)
+
+    # Calculate c, m, and yel values
+    c, _ = diff[:, :, :, 1:].min(dim=-1)
+    m, _ = diff[:, :, :, [0, 2]].min(dim=-1)
+    yel, _ = diff[:, :, :, :2].min(dim=-1)
+
+    # Calculate luminance using vectorized operations
+    luminance = min_c + red_mask * (c * cyan + (diff[:, :, :, 1] - c) * green + (diff[:, :, :, 2] - c) * blue)
+    luminance += green_mask * (m * magenta + (diff[:, :, :, 0] - m) * red + (diff[:, :, :, 2] - m) * blue)
+    luminance += blue_mask * (yel * yellow + (diff[:, :, :, 0] - yel) * red + (diff[:, :, :, 1] - yel) * green)
+
+    # Clip luminance values to be between 0 and 1
+    luminance = luminance.clamp(0, 1)
+
+    # Add an extra dimension for color channels
+    luminance = luminance.unsqueeze(-1)
+
+    # Convert grayscale to RGB by duplicating the grayscale channel
+    rgb_image = luminance.expand(-1, -1, -1, 3)
+
+    # If the original image had an alpha channel, append it back
+    if image.shape[-1] == 4:
+        alpha_channel = image[:, :, :, 3:]
+        rgb_image = torch.cat((rgb_image, alpha_channel), dim=-1)
+
+    return rgb_image
     
 
 class HueSatAdvanced():
@@ -587,36 +620,23 @@ class HueSatAdvanced():
                     "step": 0.1,
                     "round": 0.01, 
                     "display": "number"}),
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
             }
         }
 
-    def do_hue_sat(self, image, hue_low, hue_low_feather, hue_high, hue_high_feather, hue_offset, sat_offset, lightness_offset):
-        
-        # Convert image to HSV and build mask
-        image_hsv = rgb_to_hsv(image)
-        mask = create_mask(image_hsv[..., 0], image_hsv[..., 1], hue_low, hue_high, hue_low_feather, hue_high_feather)
-        # Adjust hue
-        image_hsv[..., 0] = adjust_hue(image_hsv[..., 0], hue_offset)
-
-        # Adjust saturation
-        image_hsv[..., 1] = adjust_saturation(image_hsv[..., 1], sat_offset)
-
-        # Adjust lightness
-        image_hsv = adjust_lightness(image_hsv, lightness_offset)
-
-        # Convert back to RGB
-        adjusted_image_rgb = hsv_to_rgb(image_hsv[..., :3])
-
-        # Blend the original and adjusted images based on the mask
-        blended_rgb = (adjusted_image_rgb * mask.unsqueeze(-1)) + (image[..., :3] * (1 - mask.unsqueeze(-1)))
-
-        # Include the alpha channel if present
-        if image.shape[-1] == 4:
-            blended_rgba = torch.cat((blended_rgb, image[..., 3:4]), dim=-1)
-        else:
-            blended_rgba = blended_rgb
-
-        return (blended_rgba, mask)
+    def do_hue_sat(self, image, hue_low, hue_low_feather, hue_high, hue_high_feather, hue_offset, sat_offset, lightness_offset, tile_size=0, precision="float32"):
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        result = tiled(hue_sat, tile_size, image, hue_low, hue_high, hue_low_feather, hue_high_feather, hue_offset, sat_offset, lightness_offset)
+        return restore_precision(result, dtype)
 
 
 class HueSat():
@@ -654,13 +674,19 @@ class HueSat():
                     "step": 0.1,
                     "round": 0.01, 
                     "display": "number"}),
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
             }
         }
 
-    def do_hue_sat(self, image, hue, hue_width, feather, hue_offset, sat_offset, lightness_offset):
-        
-        # Convert image to HSV 
-        image_hsv = rgb_to_hsv(image)
+    def do_hue_sat(self, image, hue, hue_width, feather, hue_offset, sat_offset, lightness_offset, tile_size=0, precision="float32"):
 
         # Calculate ranges from parameters
         hues = {"red": 0, "yellow": 60, "green": 120, "cyan": 180, "blue": 240, "magenta": 300}
@@ -672,30 +698,41 @@ class HueSat():
             hue_low = 360 + hue_low
         hue_high = base_hue + (widths[hue_width]/2)
 
-        mask = create_mask(image_hsv[..., 0], image_hsv[..., 1], hue_low, hue_high, feathers[feather]/2, feathers[feather]/2)
-        
-        # Adjust hue
-        image_hsv[..., 0] = adjust_hue(image_hsv[..., 0], hue_offset)
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        result = tiled(hue_sat, tile_size, image, hue_low, hue_high, feathers[feather]/2, feathers[feather]/2, hue_offset, sat_offset, lightness_offset)
+        return restore_precision(result, dtype)
 
-        # Adjust saturation
-        image_hsv[..., 1] = adjust_saturation(image_hsv[..., 1], sat_offset)
+def hue_sat(image, hue_low, hue_high, hue_low_feather, hue_high_feather, hue_offset, sat_offset, lightness_offset):
+    
+    # Convert image to HSV and build mask. The HSV image may be shared with other nodes through the
+    # HSV cache, so it is only read: the adjustments are made in a copy.
+    image_hsv = rgb_to_hsv(image)
+    mask = create_mask(image_hsv[..., 0], image_hsv[..., 1], hue_low, hue_high, hue_low_feather, hue_high_feather)
+    adjusted_hsv = image_hsv[..., :3].clone()
 
-        # Adjust lightness
-        image_hsv = adjust_lightness(image_hsv, lightness_offset)
+    # Adjust hue
+    adjusted_hsv[..., 0] = adjust_hue(image_hsv[..., 0], hue_offset)
 
-        # Convert back to RGB
-        adjusted_image_rgb = hsv_to_rgb(image_hsv[..., :3])
+    # Adjust saturation
+    adjusted_hsv[..., 1] = adjust_saturation(image_hsv[..., 1], sat_offset)
 
-        # Blend the original and adjusted images based on the mask
-        blended_rgb = (adjusted_image_rgb * mask.unsqueeze(-1)) + (image[..., :3] * (1 - mask.unsqueeze(-1)))
+    # Adjust lightness
+    adjusted_hsv = adjust_lightness(adjusted_hsv, lightness_offset)
 
-        # Include the alpha channel if present
-        if image.shape[-1] == 4:
-            blended_rgba = torch.cat((blended_rgb, image[..., 3:4]), dim=-1)
-        else:
-            blended_rgba = blended_rgb
+    # Convert back to RGB
+    adjusted_image_rgb = hsv_to_rgb(adjusted_hsv)
 
-        return (blended_rgba, mask)
+    # Blend the original and adjusted images based on the mask
+    blended_rgb = (adjusted_image_rgb * mask.unsqueeze(-1)) + (image[..., :3] * (1 - mask.unsqueeze(-1)))
+
+    # Include the alpha channel if present
+    if image.shape[-1] == 4:
+        blended_rgba = torch.cat((blended_rgb, image[..., 3:4]), dim=-1)
+    else:
+        blended_rgba = blended_rgb
+
+    return (blended_rgba, mask)
 
 ## Support functions
 def create_solid_rgb(r, g, b, h, w):
@@ -783,9 +820,8 @@ def adjust_hue(hue, hue_offset):
     new_hue = (hue + hue_offset_normalized) % 1.0
     return new_hue
 
-def adjust_lightness(image, lightness_offset):
-    
-    image_hsv = image.clone()
+def adjust_lightness(image_hsv, lightness_offset):
+    # Adjusts the HSV image in place
 
     # Map lightness_offset to [-1, 1]
     offset = lightness_offset / 100.0
@@ -2,9 +2,11 @@
 @author: Chris Freilich
 @title: Virtuoso Pack - Contrast
 @nickname: Virtuoso Pack - Contrast
-@description: This extension provides a "Levels" node.
+@description: This extension provides "Levels" and "Levels Advanced" nodes.
 """
-import torch
+from .lut import build_lut, apply_lut
+from .precision import precision_names, to_precision, restore_precision
+from .tiling import tiled
 
 class Levels:
     
@@ -53,6 +55,15 @@ class Levels:
                     "step": 0.01,
                     "round": 0.001, 
                     "display": "number"}),
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
             }
         }
 
@@ -60,7 +71,7 @@ class Levels:
     FUNCTION = "do_levels"
     CATEGORY = "Virtuoso/Adjustment"
 
-    def do_levels(self, image, channel, input_black_point, input_gamma, input_white_point, output_black_point, output_white_point):
+    def do_levels(self, image, channel, input_black_point, input_gamma, input_white_point, output_black_point, output_white_point, tile_size=0, precision="float32"):
         """
         Applies levels adjustment to an input image tensor.
 
@@ -72,35 +83,102 @@ class Levels:
             input_gamma (float): Gamma value (controls contrast).
             output_black_point (float): New black point value (lower bound of output range).
             output_white_point (float): New white point value (upper bound of output range).
+            tile_size (int): Process the image in tiles of this size to bound memory use (0 = whole image).
+            precision (str): Compute dtype ('float32', 'float16' or 'bfloat16'). The output keeps the input's dtype.
+
+        Returns:
+            Tuple[torch.Tensor]: Output tensor with the adjusted pixel values in a tuple.
+        """
+        # The adjustment of each color channel it applies to. Other channels and alpha are left as they are.
+        curve = levels_curve(input_black_point, input_gamma, input_white_point, output_black_point, output_white_point)
+        curves = [curve if channel in ('RGB', color) else None for color in ('red', 'green', 'blue')]
+        lut = levels_lut(curves, [input_gamma], image.device)
+
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        return (restore_precision(tiled(apply_levels, tile_size, image, curves, lut), dtype),)
+
+
+class LevelsAdvanced:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+
+        # The five Levels settings, once for the composite and once for each color channel
+        settings = {name: spec for name, spec in Levels.INPUT_TYPES()["required"].items() if name not in ("image", "channel")}
+        required = {"image": ("IMAGE",)}
+        for prefix in ("rgb", "red", "green", "blue"):
+            required.update({f"{prefix}_{name}": spec for name, spec in settings.items()})
+
+        return {
+            "required": required,
+            "optional": Levels.INPUT_TYPES()["optional"],
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "do_levels"
+    CATEGORY = "Virtuoso/Adjustment"
+
+    def do_levels(self, image, tile_size=0, precision="float32", **settings):
+        """
+        Applies levels to each color channel and then to the composite, in one pass.
+
+        Args:
+            image (torch.Tensor): Input image tensor with shape [batch size, height, width, num color channels].
+            tile_size (int): Process the image in tiles of this size to bound memory use (0 = whole image).
+            precision (str): Compute dtype ('float32', 'float16' or 'bfloat16'). The output keeps the input's dtype.
+            **settings (float): The Levels node's five settings, prefixed with 'rgb_', 'red_', 'green_' or 'blue_'.
 
         Returns:
             Tuple[torch.Tensor]: Output tensor with the adjusted pixel values in a tuple.
         """
-        # Determine if there is an alpha channel
-        has_alpha = image.shape[-1] in [2, 4]
-        alpha_channel = image[..., -1:] if has_alpha else None
-
-        # Extract the color channels (excluding alpha if present)
-        color_channels = image[..., :-1] if has_alpha else image
-
-        # Initialize a tensor to hold the adjusted color channels
-        adjusted_color = torch.zeros_like(color_channels)
-
-        # Apply the levels adjustment curve to the specified channel(s)
-        for i, color in enumerate(['red', 'green', 'blue']):
-            if channel == 'RGB' or channel == color:
-                adjusted_channel = ((color_channels[..., i] - input_black_point) / (input_white_point - input_black_point)) ** input_gamma
-                adjusted_channel = torch.clamp(adjusted_channel, 0.0, 1.0)
-                adjusted_channel = output_black_point + (adjusted_channel * (output_white_point - output_black_point))
-                adjusted_color[..., i] = adjusted_channel
-            else:
-                adjusted_color[..., i] = color_channels[..., i]
-
-        # If there is an alpha channel, combine the adjusted color channels with the original alpha channel
-        if has_alpha:
-            adjusted_image = torch.cat([adjusted_color, alpha_channel], dim=-1)
-        else:
-            adjusted_image = adjusted_color
-
-        # Return the adjusted image in a tuple
-        return (adjusted_image,)
\ No newline at end of file
+        def curve(prefix):
+            return levels_curve(*(settings[f"{prefix}_{name}"] for name in
+                                  ("input_black_point", "input_gamma", "input_white_point", "output_black_point", "output_white_point")))
+
+        # Each channel's own levels come first and the composite levels after, as in Photoshop. The two
+        # are compiled into one lookup table, so the image is read once however many settings are used.
+        composite = curve("rgb")
+        curves = [lambda x, channel=curve(color): composite(channel(x)) for color in ("red", "green", "blue")]
+        lut = levels_lut(curves, [settings[f"{prefix}_input_gamma"] for prefix in ("rgb", "red", "green", "blue")], image.device)
+
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        return (restore_precision(tiled(apply_levels, tile_size, image, curves, lut), dtype),)
+
+
+def levels_curve(input_black_point, input_gamma, input_white_point, output_black_point, output_white_point):
+    # The levels adjustment of one channel, as a function for build_lut
+    def curve(x):
+        adjusted = ((x - input_black_point) / (input_white_point - input_black_point)).clamp(0.0, 1.0) ** input_gamma
+        return output_black_point + adjusted * (output_white_point - output_black_point)
+    return curve
+
+def identity_curve(x):
+    return x
+
+def levels_lut(curves, gammas, device):
+    # The lookup table of the curves, or None when they have to be evaluated directly. Below a gamma
+    # of 1 a curve gets infinitely steep at its black point, which interpolating between table
+    # entries can't follow: at a gamma of 0.1 it would be off by up to 0.3 on continuous inputs.
+    if min(gammas) < 1:
+        return None
+    return build_lut([curve or identity_curve for curve in curves], device=device)
+
+def apply_levels(image, curves, lut):
+    # Maps the color channels with a curve through the table from levels_lut, or through the curves
+    # themselves without one. Channels without a curve, and alpha, are copied as they are.
+    if lut is not None:
+        out = apply_lut(image, lut)
+    else:
+        out = image.clone()
+        for i, curve in enumerate(curves):
+            if curve is not None:
+                out[..., i] = curve(image[..., i])
+    for i, curve in enumerate(curves):
+        if curve is None:
+            out[..., i] = image[..., i]
+    return out
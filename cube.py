@@ -0,0 +1,262 @@
+"""
+@author: Chris Freilich
+@title: Virtuoso Pack - Cube LUT Files
+@nickname: Virtuoso Pack - Cube LUT Files
+@description: This extension provides "Load Cube LUT" and "Save Cube LUT" nodes, which read and write
+1D and 3D LUTs in the Adobe/Resolve .cube format.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import torch
+from .lut import LUT
+
+try:
+    import folder_paths
+except ImportError:
+    folder_paths = None # Outside of ComfyUI, e.g. in the benchmarks
+
+# Parsed .cube files are kept here as .npy tables, named by the sha256 of the file's contents, each
+# with a .json sidecar holding the rest of the LUT. Tables are memory-mapped when loaded. The folder
+# is in ComfyUI's user directory, so it survives restarts but stays out of the installed node pack.
+if folder_paths is not None:
+    cache_dir = os.path.join(folder_paths.get_user_directory(), "virtuoso_lut_cache")
+else:
+    cache_dir = os.path.join(tempfile.gettempdir(), "virtuoso_lut_cache")
+# Once the tables take up more than this, the least recently used ones are deleted
+CACHE_MAX_BYTES = 1024 ** 3
+
+class LoadCubeLUT:
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+
+        return {
+            "required": {
+                "path": ("STRING", {"default": ""}),
+            }
+        }
+
+    RETURN_TYPES = ("LUT",)
+    FUNCTION = "do_load"
+    CATEGORY = "Virtuoso/LUT"
+
+    @classmethod
+    def IS_CHANGED(s, path):
+        # Rerun when the file's contents change, not only when the path does
+        return file_hash(path) if os.path.isfile(path) else ""
+
+    def do_load(self, path):
+        """
+        Loads a 1D or 3D LUT from a .cube file.
+
+        Args:
+            path (str): Path of the .cube file.
+
+        Returns:
+            Tuple[LUT]: The LUT.
+        """
+        return (load_cube(path),)
+
+
+class SaveCubeLUT:
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+
+        return {
+            "required": {
+                "lut": ("LUT",),
+                "path": ("STRING", {"default": "look.cube"}),
+                "title": ("STRING", {"default": ""}),
+            }
+        }
+
+    RETURN_TYPES = ()
+    FUNCTION = "do_save"
+    OUTPUT_NODE = True
+    CATEGORY = "Virtuoso/LUT"
+
+    def do_save(self, lut, path, title):
+        """
+        Saves a LUT as a .cube file.
+
+        Args:
+            lut (LUT): The LUT, e.g. from Bake LUT.
+            path (str): Path of the .cube file to write, relative to ComfyUI's output directory. Missing folders are created.
+            title (str): Title written in the file's header. Empty for none.
+
+        Returns:
+            Tuple: Nothing.
+
+        Raises:
+            ValueError: If the path leads outside of the output directory.
+        """
+        save_cube(lut, path, title)
+        return ()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_cube(path):
+    """
+    Loads a .cube file, through the on-disk cache.
+
+    The file is hashed and, if a table with that hash is in the cache, it is memory-mapped instead of
+    parsing the text again. Otherwise the file is parsed and its table added to the cache.
+
+    Args:
+        path (str): Path of the .cube file.
+
+    Returns:
+        LUT: The LUT. Its table is backed by the cache file, copy-on-write.
+    """
+    key = file_hash(path)
+    table_path = os.path.join(cache_dir, f"{key}.npy")
+    info_path = os.path.join(cache_dir, f"{key}.json")
+
+    # The sidecar is written last, so a table is only used once it is complete
+    if os.path.isfile(info_path) and os.path.isfile(table_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        table = torch.from_numpy(np.load(table_path, mmap_mode="c"))
+        try:
+            os.utime(table_path) # Marks the table as recently used, for prune_cache
+        except OSError:
+            pass
+        return LUT(table, info["domain_min"], info["domain_max"])
+
+    lut = parse_cube(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Each file is written under a temporary name and renamed into place, so that other processes
+        # loading the same LUT at the same time never see a partial file
+        temporary = f"{table_path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.save(f, lut.table.numpy())
+        os.replace(temporary, table_path)
+        temporary = f"{info_path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"source": os.path.basename(path), "domain_min": lut.domain_min, "domain_max": lut.domain_max}, f)
+        os.replace(temporary, info_path)
+        prune_cache(CACHE_MAX_BYTES)
+    except OSError:
+        pass # The cache is only an optimization, e.g. the folder may be read-only
+    return lut
+
+def prune_cache(max_bytes):
+    # Deletes the least recently used tables until the rest fit in max_bytes. A sidecar is deleted
+    # before its table, so that a half-deleted entry is never used. Tables that can't be deleted
+    # (e.g. still mapped on Windows) are skipped.
+    tables = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            tables.append((stat.st_mtime, stat.st_size, name[:-len(".npy")]))
+    total = sum(size for _, size, _ in tables)
+    for _, size, key in sorted(tables):
+        if total <= max_bytes:
+            break
+        try:
+            info_path = os.path.join(cache_dir, f"{key}.json")
+            if os.path.exists(info_path):
+                os.remove(info_path)
+            os.remove(os.path.join(cache_dir, f"{key}.npy"))
+            total -= size
+        except OSError:
+            pass
+
+def parse_cube(path):
+    """
+    Parses a .cube file holding a 1D or a 3D LUT.
+
+    Args:
+        path (str): Path of the .cube file.
+
+    Returns:
+        LUT: The LUT, with a float32 table.
+
+    Raises:
+        ValueError: If the file is not a valid .cube file, or holds both a 1D and a 3D LUT.
+    """
+    size_1d = size_3d = None
+    domain_min, domain_max = [0.0] * 3, [1.0] * 3
+    values = []
+    with open(path) as f:
+        for line in f:
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            keyword = words[0].upper()
+            if keyword[0].isdigit() or keyword[0] in "-+.":
+                values.extend(words)
+            elif keyword == "LUT_1D_SIZE":
+                size_1d = int(words[1])
+            elif keyword == "LUT_3D_SIZE":
+                size_3d = int(words[1])
+            elif keyword == "DOMAIN_MIN":
+                domain_min = [float(w) for w in words[1:4]]
+            elif keyword == "DOMAIN_MAX":
+                domain_max = [float(w) for w in words[1:4]]
+            elif keyword in ("LUT_1D_INPUT_RANGE", "LUT_3D_INPUT_RANGE"):
+                # Resolve's form of the domain, the same for all three channels
+                domain_min, domain_max = [float(words[1])] * 3, [float(words[2])] * 3
+            # Other keywords, such as TITLE, don't affect the table
+
+    if (size_1d is None) == (size_3d is None):
+        raise ValueError(f"{path} must hold exactly one of LUT_1D_SIZE and LUT_3D_SIZE")
+    entries = size_1d if size_3d is None else size_3d ** 3
+    if len(values) != entries * 3:
+        raise ValueError(f"{path} should have {entries} table entries, found {len(values) / 3:g}")
+
+    data = torch.from_numpy(np.array(values, dtype=np.float32)).view(entries, 3)
+    if size_3d is None:
+        # One row per channel, as from build_lut
+        table = data.t().contiguous()
+    else:
+        # Red changes fastest in the file, so rows are [blue][green][red]
+        table = data.view(size_3d, size_3d, size_3d, 3).permute(2, 1, 0, 3).contiguous()
+    return LUT(table, domain_min, domain_max)
+
+def save_cube(lut, path, title=""):
+    # Writes a LUT in the .cube format, with red changing fastest in a 3D table
+    path = output_path(path)
+    table = lut.table.detach().float().cpu()
+    if lut.dimensions == 3:
+        header = [f"LUT_3D_SIZE {lut.size}"]
+        rows = table.permute(2, 1, 0, 3).reshape(-1, 3)
+    else:
+        header = [f"LUT_1D_SIZE {lut.size}"]
+        rows = table.t()
+    if title:
+        header.insert(0, f'TITLE "{title}"')
+    header.append("DOMAIN_MIN " + " ".join(f"{v:.6f}" for v in lut.domain_min))
+    header.append("DOMAIN_MAX " + " ".join(f"{v:.6f}" for v in lut.domain_max))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\n".join(header) + "\n")
+        np.savetxt(f, rows.numpy(), fmt="%.6f")
+
+def output_path(path):
+    # The absolute path of a file to save, which must be inside ComfyUI's output directory (the
+    # working directory outside of ComfyUI). As in ComfyUI's own save nodes, links and '..' are
+    # resolved first, so that a shared workflow can't write anywhere else on the machine.
+    output_dir = os.path.realpath(folder_paths.get_output_directory() if folder_paths is not None else os.getcwd())
+    full_path = os.path.realpath(os.path.join(output_dir, path))
+    if os.path.commonpath((output_dir, full_path)) != output_dir or full_path == output_dir:
+        raise ValueError(f"Save Cube LUT can only write inside the output directory {output_dir}, not to {path}")
+    return full_path
@@ -1,56 +1,83 @@
 import torch
+from .cache import LRUCache, tensor_key, tensor_owner
+from .precision import upcast
+
+# Converted images, shared by every node that needs the HSV form of the same frames
+hsv_cache = LRUCache(max_entries=8, max_bytes=2 * 1024 ** 3)
 
 def rgb_to_hsv(rgb):
-    # Separate the RGB channels
-    r, g, b = rgb[:, :, :, 0:1], rgb[:, :, :, 1:2], rgb[:, :, :, 2:3]
+    """
+    Converts an RGB(A) image to HSV(A), reusing an earlier conversion of the same frames.
 
-    # Compute the HSV channels
-    max_val, _ = torch.max(rgb[:, :, :, :3], dim=-1, keepdim=True)
-    min_val, _ = torch.min(rgb[:, :, :, :3], dim=-1, keepdim=True)
-    diff = max_val - min_val
+    Results are cached by the identity and version counter of the input, so a batch fed to several
+    nodes is converted once, and an input that was modified in place is converted again. Tiles and
+    other crops of an image are converted without the cache. The returned tensor may be shared
+    between callers and must not be modified.
 
-    v = max_val
+    Args:
+        rgb (torch.Tensor): Image with shape [batch size, height, width, 3 or 4].
 
-    s = diff / v
-    s = torch.where(torch.isnan(s), torch.zeros_like(s), s)
+    Returns:
+        torch.Tensor: Hue, saturation and value in 0..1 (plus the alpha channel, if any).
+    """
+    owner = tensor_owner(rgb)
+    if rgb.shape[:-1] != owner.shape[:-1]:
+        return convert_rgb_to_hsv(rgb)
 
-    h = torch.zeros_like(r)
-    h = torch.where((max_val == r) & (g >= b), ((g - b) / diff) / 6, h)
-    h = torch.where((max_val == r) & (g < b), ((g - b) / diff) / 6 + 1, h)
-    h = torch.where(max_val == g, ((b - r) / diff) / 6 + 1 / 3, h)
-    h = torch.where(max_val == b, ((r - g) / diff) / 6 + 2 / 3, h)
-    h = torch.where(max_val == min_val, torch.zeros_like(h), h)
+    key = tensor_key(rgb)
+    hsv = hsv_cache.get(key, (owner,))
+    if hsv is None:
+        hsv = hsv_cache.put(key, convert_rgb_to_hsv(rgb), (owner,))
+    return hsv
 
-    # If the input has an alpha channel, append it to the output
-    if rgb.shape[-1] == 4:
-        hsv = torch.cat((h, s, v, rgb[:, :, :, 3:4]), dim=-1)
-    else:
-        hsv = torch.cat((h, s, v), dim=-1)
+# Hue divides by the chroma and the sector math needs fine steps in h, so both conversions
+# compute in float32 even when the image is float16 or bfloat16
+@upcast
+def convert_rgb_to_hsv(rgb):
+    # The output is the only full-size allocation. It is stored one channel plane after another and
+    # returned as a [..., channels] view, so that each step below runs over contiguous planes: the
+    # RGB planes are copied in, and h, s and v replace them once they are no longer needed.
+    # An alpha channel, if present, is carried over.
+    channels = 4 if rgb.shape[-1] == 4 else 3
+    planes = rgb.new_empty((channels,) + rgb.shape[:-1])
+    planes.copy_(rgb[..., :channels].movedim(-1, 0))
+    r, g, b = planes[0], planes[1], planes[2]
+    tiny = torch.finfo(rgb.dtype).tiny
 
-    return hsv
+    # Value is the largest channel, and chroma its difference to the smallest
+    v = torch.maximum(r, g)
+    torch.maximum(v, b, out=v)
+    diff = torch.minimum(r, g)
+    torch.minimum(diff, b, out=diff)
+    diff.neg_().add_(v)
 
-def hsv_to_rgb(hsv):
-    # Separate the HSV channels
-    h, s, v = hsv[:, :, :, 0:1], hsv[:, :, :, 1:2], hsv[:, :, :, 2:3]
+    # Hue is (g - b), (b - r) + 2 * chroma or (r - g) + 4 * chroma over 6 * chroma, for a max channel
+    # of r, g or b. Divisors are kept above 0: gray pixels have a numerator of 0, so their hue is 0.
+    numerator = torch.where(g == v, (b - r).add_(diff, alpha=2), (r - g).add_(diff, alpha=4))
+    torch.where(r == v, g - b, numerator, out=numerator)
+    numerator.div_(diff.clamp_min(tiny)).div_(6)
+    torch.remainder(numerator, 1, out=r)
 
-    # Compute the RGB channels
-    i = (h * 6).floor()
-    f = h * 6 - i
-    p = v * (1 - s)
-    q = v * (1 - f * s)
-    t = v * (1 - (1 - f) * s)
+    # Saturation is chroma / value, and 0 for black
+    torch.div(diff, v.clamp_min(tiny), out=g)
+    b.copy_(v)
 
-    i = i % 6
+    return planes.movedim(0, -1)
 
-    r = torch.where(i == 0, v, torch.where(i == 1, q, torch.where(i == 2, p, torch.where(i == 3, p, torch.where(i == 4, t, v)))))
-    g = torch.where(i == 0, t, torch.where(i == 1, v, torch.where(i == 2, v, torch.where(i == 3, q, torch.where(i == 4, p, p)))))
-    b = torch.where(i == 0, p, torch.where(i == 1, p, torch.where(i == 2, t, torch.where(i == 3, v, torch.where(i == 4, v, q)))))
+@upcast
+def hsv_to_rgb(hsv):
+    # Closed form of the six hue sectors: channel n (5 for red, 3 for green, 1 for blue) is
+    # v - v * s * clamp(min(k, 4 - k), 0, 1) with k = (n + 6h) mod 6, and min(k, 4 - k) is
+    # 2 - |k - 2|. It is evaluated in place in the output's channels, the only full-size allocation.
+    h, s, v = hsv[..., 0:1], hsv[..., 1:2], hsv[..., 2:3]
+    rgb = hsv.new_empty(hsv.shape[:-1] + (4 if hsv.shape[-1] == 4 else 3,))
+    k = rgb[..., :3]
+
+    torch.add(h * 6, hsv.new_tensor([5, 3, 1]), out=k)
+    k.remainder_(6).sub_(2).abs_().neg_().add_(2)
+    k.clamp_(0, 1).mul_(-v * s).add_(v)
 
-    # If the input has an alpha channel, append it to the output
     if hsv.shape[-1] == 4:
-        rgb = torch.cat((r, g, b, hsv[:, :, :, 3:4]), dim=-1)
-    else:
-        rgb = torch.cat((r, g, b), dim=-1)
+        rgb[..., 3:4] = hsv[..., 3:4]
 
     return rgb
-
@@ -0,0 +1,307 @@
+"""
+@author: Chris Freilich
+@title: Virtuoso Pack - Lookup Tables
+@nickname: Virtuoso Pack - Lookup Tables
+@description: Lookup tables. Per-channel 1D tables compile tone curves, and chains of them, into
+one pass over the image. The "LUT Lattice", "Bake LUT" and "Apply LUT" nodes do the same for any
+chain of color adjustments with a 3D table.
+"""
+import torch
+import torch.nn.functional as F
+from .precision import precision_names, to_precision, restore_precision
+from .tiling import tiled
+
+LUT_SIZE = 4096
+
+def build_lut(curves, size=LUT_SIZE, dtype=torch.float32, device=None):
+    """
+    Samples one tone curve per channel into a lookup table.
+
+    The curves are evaluated in float64 on size evenly spaced inputs from 0 to 1. Samples that come
+    out as NaN (e.g. 0/0 at a degenerate black point) are set to 0.
+
+    Args:
+        curves (List[callable]): One function per channel, mapping a tensor of inputs to outputs.
+        size (int): Number of samples.
+        dtype (torch.dtype): Dtype of the table, normally that of the image it will be applied to.
+        device (torch.device): Device of the table.
+
+    Returns:
+        torch.Tensor: Table with shape [channels, size].
+    """
+    x = torch.linspace(0, 1, size, dtype=torch.float64)
+    table = torch.stack([curve(x) for curve in curves])
+    return table.nan_to_num_(0).to(dtype=dtype, device=device)
+
+def apply_lut(image, lut):
+    """
+    Applies a table from build_lut to the first channels of an image in one pass.
+
+    Inputs are clamped to 0..1 and interpolated linearly between the two nearest samples. Channels
+    beyond those of the table, such as alpha, are copied.
+
+    Args:
+        image (torch.Tensor): Image with shape [batch size, height, width, channels].
+        lut (torch.Tensor): Table with shape [channels of the table, size]. The math is done in float32.
+
+    Returns:
+        torch.Tensor: The mapped image, with the shape and dtype of image.
+    """
+    channels, size = lut.shape
+
+    # Each channel's samples are followed by a repeat of its last one, so that an input of exactly 1
+    # interpolates within the table. Samples and slopes to the next sample are looked up in the
+    # flattened tables, with each channel's indices offset to its own row.
+    values = torch.cat((lut, lut[:, -1:]), dim=1).float()
+    slopes = torch.diff(values, dim=1, append=values[:, -1:])
+    offsets = torch.arange(channels, dtype=torch.float32, device=image.device) * values.shape[1]
+
+    # Positions are float32 even for reduced-precision images, which can't hold the fractions at this scale
+    position = image[..., :channels].float().clamp(0, 1).mul_(size - 1)
+    fraction = torch.frac(position)
+    index = position.sub_(fraction).add_(offsets).long()
+    mapped = torch.addcmul(values.flatten().take(index), slopes.flatten().take(index), fraction)
+
+    if image.shape[-1] == channels:
+        return mapped.to(image.dtype)
+    out = torch.empty_like(image)
+    out[..., :channels] = mapped
+    out[..., channels:] = image[..., channels:]
+    return out
+
+
+class LUT:
+    """
+    A 3D or 1D lookup table and its input domain, as passed between the LUT nodes.
+
+    Attributes:
+        table (torch.Tensor): Output colors, float32. A 3D table has shape [size, size, size, 3] and is
+            indexed [red, green, blue]. A 1D table has shape [3, size], one row per channel, as from build_lut.
+        domain_min (Tuple[float]): Red, green and blue inputs that map to the first entry of each axis.
+        domain_max (Tuple[float]): Red, green and blue inputs that map to the last entry of each axis.
+    """
+    def __init__(self, table, domain_min=(0.0, 0.0, 0.0), domain_max=(1.0, 1.0, 1.0)):
+        self.table = table
+        self.domain_min = tuple(domain_min)
+        self.domain_max = tuple(domain_max)
+
+    @property
+    def dimensions(self):
+        return 3 if self.table.dim() == 4 else 1
+
+    @property
+    def size(self):
+        return self.table.shape[0] if self.dimensions == 3 else self.table.shape[1]
+
+
+class LUTLattice:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "size": ("INT", {
+                    "default": 33,
+                    "min": 2,
+                    "max": 129,
+                    "step": 1,
+                    "display": "number"}),
+            }
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "do_lattice"
+    CATEGORY = "Virtuoso/LUT"
+
+    def do_lattice(self, size):
+        """
+        Creates an image holding every color of a size x size x size RGB lattice.
+
+        Run it through a chain of per-pixel color adjustments and into Bake LUT to turn the chain
+        into a 3D LUT.
+
+        Args:
+            size (int): Number of lattice points along each of the red, green and blue axes.
+
+        Returns:
+            Tuple[torch.Tensor]: Image with shape [1, size, size * size, 3].
+        """
+        return (lattice_image(size),)
+
+
+class BakeLUT:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "lattice": ("IMAGE",),
+            }
+        }
+
+    RETURN_TYPES = ("LUT",)
+    FUNCTION = "do_bake"
+    CATEGORY = "Virtuoso/LUT"
+
+    def do_bake(self, lattice):
+        """
+        Turns a lattice image from LUT Lattice, after it went through adjustments, into a 3D LUT.
+
+        Args:
+            lattice (torch.Tensor): The adjusted lattice, with shape [1, size, size * size, 3 or 4]. Alpha is ignored.
+
+        Returns:
+            Tuple[LUT]: The 3D LUT.
+        """
+        return (bake_lattice(lattice),)
+
+
+class ApplyLUT:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+        
+        return {
+            "required": {
+                "image": ("IMAGE",),
+                "lut": ("LUT",),
+                "interpolation": (["tetrahedral", "trilinear"],),
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
+            }
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "do_apply"
+    CATEGORY = "Virtuoso/LUT"
+
+    def do_apply(self, image, lut, interpolation, tile_size=0, precision="float32"):
+        """
+        Maps the colors of an image through a 3D or 1D LUT.
+
+        Args:
+            image (torch.Tensor): Input image tensor with shape [batch size, height, width, num color channels].
+            lut (LUT): The table, e.g. from Bake LUT or Load Cube LUT.
+            interpolation (str): 'tetrahedral' (closer to the baked chain, and what most grading tools use) or 'trilinear'.
+                1D LUTs are always interpolated linearly.
+            tile_size (int): Process the image in tiles of this size to bound memory use (0 = whole image).
+            precision (str): Compute dtype ('float32', 'float16' or 'bfloat16'). The output keeps the input's dtype.
+
+        Returns:
+            Tuple[torch.Tensor]: Output tensor with the mapped pixel values in a tuple.
+        """
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        apply = apply_lut3d if lut.dimensions == 3 else apply_lut1d
+        return (restore_precision(tiled(apply, tile_size, image, lut, interpolation), dtype),)
+
+
+def lattice_image(size):
+    # Lattice point (r, g, b) is stored at row g, column b * size + r, so that the image shows one
+    # red/green square per blue level, side by side
+    steps = torch.linspace(0, 1, size)
+    red = steps.view(1, 1, size).expand(size, size, size)
+    green = steps.view(size, 1, 1).expand(size, size, size)
+    blue = steps.view(1, size, 1).expand(size, size, size)
+    return torch.stack((red, green, blue), dim=-1).reshape(1, size, size * size, 3)
+
+def bake_lattice(lattice):
+    # Inverse of lattice_image, to a table indexed [red, green, blue]
+    size = lattice.shape[1]
+    if lattice.shape[0] != 1 or lattice.shape[2] != size * size:
+        raise ValueError(f"Bake LUT needs a single image from LUT Lattice (height n, width n * n), got shape {tuple(lattice.shape)}")
+    table = lattice[0, ..., :3].float().reshape(size, size, size, 3).permute(2, 0, 1, 3)
+    return LUT(table.contiguous())
+
+def apply_lut3d(image, lut, interpolation="tetrahedral"):
+    """
+    Maps the colors of an image through a 3D LUT in one pass.
+
+    Inputs outside the LUT's domain are clamped to it. Channels beyond RGB, such as alpha, are
+    copied. The math is done in float32.
+
+    Args:
+        image (torch.Tensor): Image with shape [batch size, height, width, 3 or 4].
+        lut (LUT): The table and its domain.
+        interpolation (str): 'tetrahedral' or 'trilinear'.
+
+    Returns:
+        torch.Tensor: The mapped image, with the shape and dtype of image.
+    """
+    table = lut.table.to(image.device)
+    domain_min = image.new_tensor(lut.domain_min, dtype=torch.float32)
+    domain_max = image.new_tensor(lut.domain_max, dtype=torch.float32)
+    unit = ((image[..., :3].float() - domain_min) / (domain_max - domain_min)).clamp_(0, 1)
+
+    if interpolation == "trilinear":
+        # grid_sample's 3D linear mode is trilinear interpolation. Its x, y and z grid coordinates
+        # index the last three dims of the input, so the table is laid out [channel, blue, green, red].
+        grid = unit.mul(2).sub_(1).unsqueeze(0)
+        mapped = F.grid_sample(table.permute(3, 2, 1, 0).unsqueeze(0), grid, mode="bilinear", padding_mode="border", align_corners=True)
+        mapped = mapped[0].permute(1, 2, 3, 0)
+    else:
+        mapped = tetrahedral(table, unit)
+
+    if image.shape[-1] == 3:
+        return mapped.to(image.dtype)
+    out = torch.empty_like(image)
+    out[..., :3] = mapped
+    out[..., 3:] = image[..., 3:]
+    return out
+
+def apply_lut1d(image, lut, interpolation=None):
+    # A 1D LUT with a domain other than 0..1 (e.g. from a .cube file) is applied to the inputs
+    # rescaled to 0..1. The interpolation is always linear.
+    if lut.domain_min != (0.0, 0.0, 0.0) or lut.domain_max != (1.0, 1.0, 1.0):
+        domain_min = image.new_tensor(lut.domain_min, dtype=torch.float32)
+        domain_max = image.new_tensor(lut.domain_max, dtype=torch.float32)
+        unit = image.to(torch.float32, copy=True)
+        unit[..., :3] = (unit[..., :3] - domain_min) / (domain_max - domain_min)
+        return apply_lut(unit, lut.table.to(image.device)).to(image.dtype)
+    return apply_lut(image, lut.table.to(image.device))
+
+def tetrahedral(table, unit):
+    # The lattice cell around each color is split into six tetrahedra along its gray diagonal. The
+    # one holding the color runs from the cell's first corner one step along the axis with the
+    # largest fraction, then along the axis with the middle one, to the opposite corner, and the
+    # color is weighted between those four corners. Where fractions tie, the corner picked for
+    # either axis gets a weight of 0.
+    size = table.shape[0]
+    position = unit.reshape(-1, 3) * (size - 1)
+    base = position.floor().clamp_(max=size - 2)
+    fraction = position.sub_(base)
+    r, g, b = fraction.unbind(-1)
+    largest = fraction.amax(dim=-1)
+    smallest = fraction.amin(dim=-1)
+    middle = r + g + b - largest - smallest
+
+    # Offsets into the flattened table, int32 to keep the index tensors small
+    corner = (base[:, 0] * size + base[:, 1]).mul_(size).add_(base[:, 2]).int()
+    last = size * size + size + 1
+    first = torch.where(r == largest, size * size, torch.where(g == largest, size, 1)).int()
+    second = last - torch.where(b == smallest, 1, torch.where(g == smallest, size, size * size)).int()
+
+    flat = table.reshape(-1, 3)
+    mapped = flat.index_select(0, corner).mul_((1 - largest).unsqueeze(1))
+    mapped.addcmul_(flat.index_select(0, corner + first), (largest - middle).unsqueeze(1))
+    mapped.addcmul_(flat.index_select(0, corner + second), (middle - smallest).unsqueeze(1))
+    mapped.addcmul_(flat.index_select(0, corner + last), smallest.unsqueeze(1))
+    return mapped.reshape(unit.shape)
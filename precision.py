@@ -0,0 +1,41 @@
+import functools
+import torch
+
+# Compute dtypes offered by the pointwise nodes. float32 is the exact path; the reduced ones halve
+# memory traffic at the cost of a few 8-bit steps of error (see the README for the bounds).
+precision_names = ["float32", "float16", "bfloat16"]
+dtypes = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+def to_precision(precision, t):
+    # Casts a node input to the compute dtype. None (e.g. a missing mask) passes through.
+    return t.to(dtypes[precision]) if t is not None else None
+
+def restore_precision(result, dtype):
+    # Casts a node's output tensor, or tuple of tensors, back to the dtype of its inputs
+    if isinstance(result, torch.Tensor):
+        return result.to(dtype)
+    return tuple(restore_precision(r, dtype) for r in result)
+
+def is_reduced(t):
+    return t.dtype in (torch.float16, torch.bfloat16)
+
+def upcast(fn):
+    """
+    Runs a numerically sensitive function in float32 when its input is float16 or bfloat16.
+
+    Meant for steps that divide by small differences, where reduced precision would amplify
+    rounding errors into visible artifacts. The result is cast back to the input dtype.
+
+    Args:
+        fn (callable): Function whose first argument is a tensor. Other tensor arguments are upcast too.
+
+    Returns:
+        callable: The wrapped function.
+    """
+    @functools.wraps(fn)
+    def run(x, *args, **kwargs):
+        if not is_reduced(x):
+            return fn(x, *args, **kwargs)
+        args = [a.float() if isinstance(a, torch.Tensor) else a for a in args]
+        return fn(x.float(), *args, **kwargs).to(x.dtype)
+    return run
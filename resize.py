@@ -1,47 +1,46 @@
 import torch.nn.functional as F
 
 def match_sizes(match_size, top, bottom, m=None):
-    top_layer = top.clone()
-    bottom_layer = bottom.clone()
+    # Layers and masks come back as views whenever no resize is needed. Batches are left
+    # as they are (1 or N), so that the blend math can broadcast them.
+    height, width = bottom.shape[1], bottom.shape[2]
     mask = None
 
     # Resize top_layer and mask to match bottom_layer
     if match_size == 'stretch':
-        top_layer = F.interpolate(top_layer.permute(0, 3, 1, 2), size=(bottom_layer.shape[1], bottom_layer.shape[2]), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
+        top_layer = resize_image(top, height, width)
 
         if m is not None:
             # Resize mask to match bottom_layer size
-            mask = F.interpolate(m.unsqueeze(1), size=(bottom_layer.shape[1], bottom_layer.shape[2]), mode='nearest').squeeze(1).clone()
+            mask = resize_mask(m, height, width)
     else:
-        # Calculate the scale factors for both dimensions separately
-        scale_factor_h = bottom_layer.shape[1] / top_layer.shape[1]
-        scale_factor_w = bottom_layer.shape[2] / top_layer.shape[2]
+        # Resize top_layer while keeping aspect ratio constant, then crop it to match bottom_layer size
+        top_layer = resize_image(top, *cover_size(top, height, width))
+        top_layer = top_layer[:, :height, :width, :]
 
-        # Use the correct scale factor to resize the top_layer
-        scale_factor = max(scale_factor_w, scale_factor_h) # must grow/shrink while covering both dimensions of bottom_layer
-
-        new_h = round(top_layer.shape[1] * scale_factor)
-        new_w = round(top_layer.shape[2] * scale_factor)
-
-        # Resize top_layer while keeping aspect ratio constant
-        top_layer = F.interpolate(top_layer.permute(0, 3, 1, 2), size=(new_h, new_w), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
+        if m is not None:
+            # Resize and crop mask in the same way
+            mask = resize_mask(m, *cover_size(m, height, width))
+            mask = mask[:, :height, :width]
 
-        # Crop top_layer to match bottom_layer size
-        top_layer = top_layer[:, :bottom_layer.shape[1], :bottom_layer.shape[2], :]
+    return top_layer, mask
 
-        if m is not None:
-            # Calculate the scale factors for both dimensions separately for mask
-            scale_factor_mask_h = bottom_layer.shape[1] / m.shape[1]
-            scale_factor_mask_w = bottom_layer.shape[2] / m.shape[2]
+def cover_size(t, height, width):
+    # Calculate the scale factors for both dimensions separately
+    scale_factor_h = height / t.shape[1]
+    scale_factor_w = width / t.shape[2]
 
-            # Use the correct scale factor to resize the mask
-            scale_factor_mask = max(scale_factor_mask_w, scale_factor_mask_h) # must grow to cover both dimensions
+    # Use the correct scale factor to resize
+    scale_factor = max(scale_factor_w, scale_factor_h) # must grow/shrink while covering both dimensions
 
-            new_h_mask = round(m.shape[1] * scale_factor_mask)
-            new_w_mask = round(m.shape[2] * scale_factor_mask)
+    return round(t.shape[1] * scale_factor), round(t.shape[2] * scale_factor)
 
-            # Resize and crop mask in the same way
-            mask = F.interpolate(m.unsqueeze(1), size=(new_h_mask, new_w_mask), mode='nearest').squeeze(1).clone()
-            mask = mask[:, :bottom_layer.shape[1], :bottom_layer.shape[2]]
+def resize_image(image, height, width):
+    if image.shape[1] == height and image.shape[2] == width:
+        return image
+    return F.interpolate(image.permute(0, 3, 1, 2), size=(height, width), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
 
-    return top_layer, mask
\ No newline at end of file
+def resize_mask(mask, height, width):
+    if mask.shape[1] == height and mask.shape[2] == width:
+        return mask
+    return F.interpolate(mask.unsqueeze(1), size=(height, width), mode='nearest').squeeze(1)
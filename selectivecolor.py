@@ -2,13 +2,18 @@
 @author: Chris Freilich
 @title: Virtuoso Pack - Selective Color
 @nickname: Virtuoso Pack - Selective Color
-@description: This extension provides a selective color node.
+@description: This extension provides "Selective Color" and "Selective Color Multi" nodes.
 """
-import torch
-import torchvision.transforms as transforms
 import subprocess
-import imageio
-import tempfile
+import threading
+import numpy as np
+import torch
+from .precision import precision_names, to_precision, restore_precision
+from .tiling import tiled
+from .workers import map_chunks
+
+color_ranges = ["reds", "yellows","greens", "cyans","blues", "magentas","whites", "neutrals", "blacks"]
+engines = ["torch", "ffmpeg"]
 
 class SelectiveColor:
     
@@ -21,7 +26,7 @@ class SelectiveColor:
         return {
             "required": {
                 "image": ("IMAGE",),
-                "color_range": (["reds", "yellows","greens", "cyans","blues", "magentas","whites", "neutrals", "blacks"],),
+                "color_range": (color_ranges,),
                 "cyan": ("FLOAT", {
                     "default": 0.0,
                     "min": -1.0,
@@ -51,6 +56,16 @@ class SelectiveColor:
                     "round": 0.01, 
                     "display": "number"}),
                 "method": (["absolute", "relative"],),
+            },
+            "optional": {
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 64,
+                    "display": "number"}),
+                "precision": (precision_names,),
+                "engine": (engines,),
             }
         }
 
@@ -58,47 +73,219 @@ class SelectiveColor:
     FUNCTION = "do_selectivecolor"
     CATEGORY = "Virtuoso/Adjustment"
     
-    def do_selectivecolor(self, image, color_range, cyan, magenta, yellow, black, method):
-        
-        output_tensors = []
+    def do_selectivecolor(self, image, color_range, cyan, magenta, yellow, black, method, tile_size=0, precision="float32", engine="torch"):
+        """
+        Adjusts the amounts of cyan, magenta, yellow and black in one range of colors or gray values.
+
+        Args:
+            image (torch.Tensor): Input image tensor with shape [batch size, height, width, num color channels].
+            color_range (str): The range to adjust ('reds', 'yellows', ..., 'whites', 'neutrals', 'blacks').
+            cyan, magenta, yellow, black (float): Amounts to add (positive) or remove (negative), from -1 to 1.
+            method (str): 'absolute' or 'relative' (changes scaled by the current amount).
+            tile_size (int): Process the image in tiles of this size to bound memory use (0 = whole image).
+            precision (str): Compute dtype ('float32', 'float16' or 'bfloat16'). The output keeps the input's dtype.
+            engine (str): 'torch', or 'ffmpeg' to run ffmpeg's selectivecolor filter (tile_size and precision don't apply).
+
+        Returns:
+            Tuple[torch.Tensor]: Output tensor with the adjusted pixel values in a tuple.
+        """
+        adjustments = {color_range: (cyan, magenta, yellow, black)}
+        if engine == "ffmpeg":
+            return (ffmpeg_selective_color(image, adjustments, method),)
+
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        return (restore_precision(tiled(selective_color, tile_size, image, adjustments, method), dtype),)
+
+
+class SelectiveColorMulti:
+    
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(s):
+
+        # The cyan, magenta, yellow and black settings of Selective Color, once for every range
+        settings = {name: spec for name, spec in SelectiveColor.INPUT_TYPES()["required"].items() if name in ("cyan", "magenta", "yellow", "black")}
+        required = {"image": ("IMAGE",)}
+        for color_range in color_ranges:
+            required.update({f"{color_range}_{name}": spec for name, spec in settings.items()})
+        required["method"] = (["absolute", "relative"],)
+
+        return {
+            "required": required,
+            "optional": SelectiveColor.INPUT_TYPES()["optional"],
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "do_selectivecolor"
+    CATEGORY = "Virtuoso/Adjustment"
+
+    def do_selectivecolor(self, image, method, tile_size=0, precision="float32", engine="torch", **settings):
+        """
+        Adjusts the amounts of cyan, magenta, yellow and black in every color and gray range, in one pass.
+
+        Args:
+            image (torch.Tensor): Input image tensor with shape [batch size, height, width, num color channels].
+            method (str): 'absolute' or 'relative' (changes scaled by the current amount).
+            tile_size (int): Process the image in tiles of this size to bound memory use (0 = whole image).
+            precision (str): Compute dtype ('float32', 'float16' or 'bfloat16'). The output keeps the input's dtype.
+            engine (str): 'torch', or 'ffmpeg' to run ffmpeg's selectivecolor filter (tile_size and precision don't apply).
+            **settings (float): The cyan, magenta, yellow and black amounts, prefixed with the range name (e.g. 'reds_cyan').
+
+        Returns:
+            Tuple[torch.Tensor]: Output tensor with the adjusted pixel values in a tuple.
+        """
+        adjustments = {color_range: tuple(settings[f"{color_range}_{name}"] for name in ("cyan", "magenta", "yellow", "black"))
+                       for color_range in color_ranges}
+        if engine == "ffmpeg":
+            return (ffmpeg_selective_color(image, adjustments, method),)
+
+        dtype = image.dtype
+        image = to_precision(precision, image)
+        return (restore_precision(tiled(selective_color, tile_size, image, adjustments, method), dtype),)
+
+
+def selective_color(image, adjustments, method):
+    """
+    Selective color with the math of ffmpeg's selectivecolor filter, on a whole batch at once.
+
+    Each pixel belongs to the ranges its channels qualify it for (e.g. reds where red is the largest
+    channel, whites where every channel is above 0.5), weighted by how strongly it does. For each of
+    its ranges, the range's cyan, magenta and yellow settings move red, green and blue, and black
+    moves all three.
+
+    The work doesn't grow with the number of ranges adjusted: a pixel is in at most one range of each
+    of the groups in range_groups, so each group's settings are picked per pixel and applied together.
+
+    Args:
+        image (torch.Tensor): Image with shape [batch size, height, width, 3 or 4]. Alpha is copied.
+        adjustments (Dict[str, Tuple[float]]): Cyan, magenta, yellow and black amounts by range name.
+            Missing ranges are not adjusted.
+        method (str): 'absolute' or 'relative'.
+
+    Returns:
+        torch.Tensor: The adjusted image.
+    """
+    rgb = image[..., :3]
+    r, g, b = rgb.unbind(-1)
+    max_val = rgb.amax(dim=-1)
+    min_val = rgb.amin(dim=-1)
+    mid_val = r + g + b - max_val - min_val
+
+    adjustment = torch.zeros_like(rgb)
+    for group in range_groups:
+        settings = [adjustments.get(color_range, (0, 0, 0, 0)) for color_range in group]
+        if not any(any(amounts) for amounts in settings):
+            continue
+
+        # Each pixel's weight in the group, and the settings of the range it is in
+        selectors, scale = group_membership(group, r, g, b, min_val, mid_val, max_val)
+        amounts = rgb.new_tensor(settings[-1])
+        for selector, setting in zip(reversed(selectors), reversed(settings[:-1])):
+            amounts = torch.where(selector.unsqueeze(-1), rgb.new_tensor(setting), amounts)
+        cmy, black = amounts[..., :3], amounts[..., 3:]
+
+        # Removing a color adds its complement (cyan is negative red, and so on), and black darkens
+        # all three channels. Each change is limited to what the channel can take.
+        change = ((-1 - cmy) * black - cmy).expand_as(rgb)
+        if method == "relative":
+            change = change * (1 - rgb)
+        change = torch.clamp(change, -rgb, 1 - rgb)
+        adjustment.addcmul_(change, scale.unsqueeze(-1))
+
+    out = image.clone()
+    out[..., :3] = (rgb + adjustment).clamp_(0, 1)
+    return out
+
+# Groups of ranges that no pixel is in more than one of: the range of its largest channel, that of
+# its smallest channel, whites or blacks, and neutrals
+range_groups = (("reds", "greens", "blues"), ("cyans", "magentas", "yellows"), ("whites", "blacks"), ("neutrals",))
 
-        # Create a temporary directory using the tempfile module
-        with tempfile.TemporaryDirectory() as tmpdirname:
+def group_membership(group, r, g, b, min_val, mid_val, max_val):
+    # Returns masks that pick a pixel's range within the group (the last range being the fallback),
+    # and how strongly the pixel belongs to it, 0 outside the group. Where two channels tie for the
+    # largest or smallest, mid_val equals them and the weight comes out 0.
+    if group[0] == "reds":
+        return [r == max_val, g == max_val], max_val - mid_val
+    if group[0] == "cyans":
+        return [r == min_val, g == min_val], mid_val - min_val
+    if group[0] == "whites":
+        # Whites need every channel above 0.5 and blacks every channel below it, so at most one of
+        # the two weights is positive
+        return [min_val > 0.5], torch.maximum(2 * min_val - 1, 1 - 2 * max_val).clamp_min_(0)
+    # Neutrals are weighted toward mid gray. Pure black and pure white come out 0.
+    return [], 1 - (max_val - 0.5).abs() - (min_val - 0.5).abs()
 
-            # Iterate over each image in the batch
-            for i in range(image.shape[0]):
-                
-                batch_image = image[i]
+def ffmpeg_selective_color(image, adjustments, method):
+    """
+    Runs a batch through ffmpeg's selectivecolor filter, for exact parity with ffmpeg.
 
-                # Permute the dimensions to be in the format expected by ToPILImage (C x H x W)
-                batch_image = batch_image.permute(2, 0, 1)
+    The batch is cut into chunks (see workers.map_chunks), each handled by its own ffmpeg process
+    on the shared worker pool, so that long batches use every core. Frames are streamed to each
+    process and back as 16-bit raw video over pipes (rgb48le, or rgba64le with alpha), so nothing
+    touches the disk and there is no 8-bit rounding. ffmpeg must be on the PATH.
 
-                # Convert the PyTorch tensor to a PIL image
-                img_pil = transforms.ToPILImage()(batch_image)
-                img_pil.save(f"{tmpdirname}/temp{i}.png")
+    Args:
+        image (torch.Tensor): Image with shape [batch size, height, width, 3 or 4].
+        adjustments (Dict[str, Tuple[float]]): Cyan, magenta, yellow and black amounts by range name.
+        method (str): 'absolute' or 'relative'.
 
-                # Construct the ffmpeg command
-                command = ["ffmpeg", "-i", f"{tmpdirname}/temp{i}.png", "-vf"]
-                command.append(f"selectivecolor={method}:{color_range}={cyan} {magenta} {yellow} {black}")
-                command.extend(["-update", "1", f"{tmpdirname}/output{i}.png"])
+    Returns:
+        torch.Tensor: The adjusted image, with the dtype and device of image.
 
-                # Run the ffmpeg command
-                subprocess.run(command)
+    Raises:
+        RuntimeError: If ffmpeg can't be started, exits with an error or returns fewer frames.
+    """
+    return map_chunks(run_ffmpeg_selective_color, image, adjustments, method)
 
-                # Load the output image as a PyTorch tensor
-                img_array = imageio.imread(f"{tmpdirname}/output{i}.png")
-                img_tensor = transforms.ToTensor()(img_array)
+def run_ffmpeg_selective_color(image, adjustments, method):
+    # Runs frames through one ffmpeg process (see ffmpeg_selective_color)
+    batch, height, width, channels = image.shape
+    pix_fmt = "rgba64le" if channels == 4 else "rgb48le"
+    ranges = ":".join(f"{color_range}={cyan} {magenta} {yellow} {black}" for color_range, (cyan, magenta, yellow, black) in adjustments.items())
+    command = ["ffmpeg", "-v", "error", "-nostdin",
+               "-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{width}x{height}", "-i", "pipe:0",
+               "-vf", f"selectivecolor=correction_method={method}:{ranges}",
+               "-f", "rawvideo", "-pix_fmt", pix_fmt, "pipe:1"]
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError("The ffmpeg engine of Selective Color needs ffmpeg on the PATH. See https://ffmpeg.org/download.html.")
 
-                # Permute the dimensions back to the original format (H x W x C)
-                img_tensor = img_tensor.permute(1, 2, 0)
+    # Frames are written and the error output is collected on their own threads, while this one
+    # reads the results, so that no pipe fills up and stalls ffmpeg
+    def write_frames():
+        try:
+            for frame in image:
+                process.stdin.write((frame.clamp(0, 1) * 65535).round_().cpu().numpy().astype("<u2").tobytes())
+            process.stdin.close()
+        except OSError:
+            pass # ffmpeg stopped early. Its exit code and error output are reported below.
 
-                # Add the output tensor to the list
-                output_tensors.append(img_tensor)
+    errors = []
+    threads = [threading.Thread(target=write_frames, daemon=True),
+               threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)]
+    for thread in threads:
+        thread.start()
 
-        # Stack the output tensors along a new dimension to form a batch
-        output_batch = torch.stack(output_tensors)
+    out = torch.empty((batch, height, width, channels), dtype=torch.float32)
+    frame_bytes = height * width * channels * 2
+    frames = 0
+    while frames < batch:
+        data = process.stdout.read(frame_bytes)
+        if len(data) < frame_bytes:
+            break
+        out[frames] = torch.from_numpy(np.frombuffer(data, dtype="<u2").astype(np.float32)).view(height, width, channels) / 65535
+        frames += 1
+    process.stdout.close()
 
-        # Return the output batch
-        return (output_batch,)
+    code = process.wait()
+    for thread in threads:
+        thread.join()
+    if code != 0 or frames < batch:
+        message = errors[0].decode(errors="replace").strip() if errors else ""
+        raise RuntimeError(f"ffmpeg selectivecolor failed (exit code {code}, {frames} of {batch} frames returned): {message}")
 
-                
+    return out.to(device=image.device, dtype=image.dtype)
@@ -0,0 +1,44 @@
+import torch
+
+def tiled(fn, tile_size, *args, **kwargs):
+    """
+    Runs a pointwise image function over square tiles and writes each result tile into full-size outputs.
+
+    Every tensor argument laid out as [batch, height, width, ...] (images and masks) is cut into
+    tile_size x tile_size tiles. Other arguments are passed to fn unchanged. Temporaries inside fn
+    then scale with the tile size instead of the image size, and each pixel goes through the same
+    arithmetic as in an untiled call.
+
+    Args:
+        fn (callable): Function returning a tensor or a tuple of tensors shaped like its image arguments.
+        tile_size (int): Tile edge in pixels. 0 calls fn once on the whole image.
+
+    Returns:
+        torch.Tensor or Tuple[torch.Tensor]: Whatever fn returns, assembled at full size.
+    """
+    images = [a for a in args if isinstance(a, torch.Tensor) and a.dim() >= 3]
+    if not tile_size or not images:
+        return fn(*args, **kwargs)
+
+    height, width = images[0].shape[1], images[0].shape[2]
+    if height <= tile_size and width <= tile_size:
+        return fn(*args, **kwargs)
+
+    def is_planar(a):
+        return isinstance(a, torch.Tensor) and a.dim() >= 3 and a.shape[1] == height and a.shape[2] == width
+
+    outputs = None
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile_args = [a[:, y:y + tile_size, x:x + tile_size] if is_planar(a) else a for a in args]
+            result = fn(*tile_args, **kwargs)
+            single = isinstance(result, torch.Tensor)
+            tiles = (result,) if single else result
+
+            # Outputs are allocated once the first tile shows their batch size, channels and dtype
+            if outputs is None:
+                outputs = [t.new_empty((t.shape[0], height, width) + tuple(t.shape[3:])) for t in tiles]
+            for out, t in zip(outputs, tiles):
+                out[:, y:y + tile_size, x:x + tile_size] = t
+
+    return outputs[0] if single else tuple(outputs)
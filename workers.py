@@ -0,0 +1,80 @@
+"""
+@author: Chris Freilich
+@title: Virtuoso Pack - Workers
+@nickname: Virtuoso Pack - Workers
+@description: A thread pool shared by the nodes, for per-frame work that runs outside of PyTorch.
+"""
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+def env_count(name):
+    # A non-negative whole number from the environment, or 0 (the default) if it is unset or invalid.
+    # A bad value only logs a warning, so that a typo can't stop the nodes from loading.
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        logging.warning(f"Virtuoso Pack: ignoring {name}={value!r}, which is not a whole number")
+        return 0
+
+# The pool is configured only through these environment variables, read once at import.
+# Number of worker threads, one per CPU core unless VIRTUOSO_WORKERS is set. The work they are meant
+# for (external processes such as ffmpeg, or libraries that release the GIL) doesn't hold the GIL.
+max_workers = env_count("VIRTUOSO_WORKERS") or os.cpu_count() or 1
+# Largest number of frames handed to a worker at once, to bound the memory each one holds. 0 splits
+# a batch evenly across the workers.
+chunk_frames = env_count("VIRTUOSO_CHUNK_FRAMES")
+
+_pool = None
+_lock = threading.Lock()
+_local = threading.local()
+
+def get_pool():
+    # The pool is created on first use, so that importing the nodes starts no threads
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="virtuoso", initializer=_mark_worker)
+        return _pool
+
+def _mark_worker():
+    _local.is_worker = True
+
+def map_chunks(fn, batch, *args, **kwargs):
+    """
+    Runs a function over chunks of a batch on the shared pool and joins the results in order.
+
+    The batch is cut along its first dim into chunks of chunk_frames frames (or into one chunk per
+    worker), and fn is called once per chunk with the other arguments. A call from inside a worker
+    runs inline instead, so that nested calls can't wait on a pool they are filling up. If any chunk
+    raises, the chunks not yet started are cancelled, and the exception of the first failing chunk
+    is raised once the running ones finish.
+
+    Args:
+        fn (callable): Takes a chunk of the batch and the other arguments, and returns a tensor with one entry per frame of the chunk.
+        batch (torch.Tensor): Frames, with shape [batch size, ...].
+
+    Returns:
+        torch.Tensor: The results of all chunks, concatenated in the order of the batch.
+    """
+    frames = chunk_frames or math.ceil(batch.shape[0] / max_workers)
+    if frames >= batch.shape[0] or getattr(_local, "is_worker", False):
+        return fn(batch, *args, **kwargs)
+
+    futures = [get_pool().submit(fn, chunk, *args, **kwargs) for chunk in batch.split(frames)]
+    try:
+        results = [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                future.exception()
+        raise
+    return torch.cat(results)